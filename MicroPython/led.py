@@ -4,19 +4,36 @@ import machine
 
 
 class LED:
+    # Patterns are on/off durations in ms, starting with 'on', and whether they repeat
+    PATTERNS = {
+        "blink": ((100, 100, 100, 100), False),
+        "flash": ((50, 50) * 10, False),
+        "heartbeat": ((80, 120, 80, 720), True),
+        "connecting": ((1000, 1000), True),
+        "connected": ((200, 100) * 6, False),
+    }
 
-    def __init__(self, led_pin="LED"):
+    def __init__(self, led_pin="LED", timer_id=-1):
         self.led = machine.Pin(led_pin, machine.Pin.OUT)
         self.led.off()
         self.status = 0
+        self._timer = machine.Timer(timer_id)
+        self._step_cb = self._step  # Bound once so the timer callback doesn't allocate
+        self._pattern = None
+        self._repeat = False
+        self._index = 0
+
+    def _set(self, value):
+        self.led.value(value)
+        self.status = value
 
     def on(self):
-        self.led.on()
-        self.status = 1
+        self.stop()
+        self._set(1)
 
     def off(self):
-        self.led.off()
-        self.status = 0
+        self.stop()
+        self._set(0)
 
     def toggle(self):
         if self.status == 0:
@@ -24,20 +41,56 @@ class LED:
         else:
             self.off()
 
+    @property
+    def busy(self):
+        return self._pattern is not None
 
-    def blink(self, times=2, on_delay=0.1, off_delay=0.1):
-        for _ in range(times):
-            self.on()
-            time.sleep(on_delay)
-            self.off()
-            time.sleep(off_delay)
+    def play(self, pattern, repeat=None):
+        # Start a named pattern or a tuple of on/off durations in ms. Returns right away;
+        # the pattern runs from a timer and replaces whatever was playing before.
+        self.stop()
+        if isinstance(pattern, str):
+            pattern, default_repeat = self.PATTERNS[pattern]
+            if repeat is None:
+                repeat = default_repeat
+        self._pattern = pattern
+        self._repeat = bool(repeat)
+        self._index = 0
+        self._step()
+
+    def error(self, code):
+        # Blink the error code, pause, repeat until something else is played
+        self.play((200, 200) * (code - 1) + (200, 1200), repeat=True)
+
+    def stop(self):
+        self._timer.deinit()
+        self._pattern = None
+
+    def _step(self, timer=None):
+        pattern = self._pattern
+        if pattern is None:
+            return
+        if self._index >= len(pattern):
+            if not self._repeat:
+                self._pattern = None
+                self._set(0)
+                return
+            self._index = 0
+        self._set(1 - self._index % 2)
+        period = pattern[self._index]
+        self._index += 1
+        self._timer.init(mode=machine.Timer.ONE_SHOT, period=period, callback=self._step_cb)
+
+    def blink(self, times=2, on_delay=0.1, off_delay=0.1, wait=False):
+        self.play((int(on_delay * 1000), int(off_delay * 1000)) * times)
+        while wait and self.busy:
+            time.sleep(0.01)
 
 
 if __name__ == "__main__":
     led = LED()
-    led.led = machine.Pin("LED", machine.Pin.OUT)
 
     # Flash the LED 3 times with specified delays
-    led.blink(times=3, on_delay=0.2, off_delay=0.2)
+    led.blink(times=3, on_delay=0.2, off_delay=0.2, wait=True)
 
     print("LED flash completed.")
@@ -9,12 +9,11 @@ from wifi_connect import WiFiConnect
 mac_finder = FindMAC()
 mac_address = mac_finder.get_mac()
 
-wifi_connector = WiFiConnect("FatFreddy", "wifi@PSWMSW2h")
-wifi_connector.connect_to_wifi()
-
-
 led = LED()
 
+wifi_connector = WiFiConnect("FatFreddy", "wifi@PSWMSW2h", led=led)
+wifi_connector.connect_to_wifi()
+
 
 def on_message(topic, payload):
     print(f"Received message on {topic}: {payload}")
@@ -1,104 +1,416 @@
-import json
 import machine
 import network
+import payload_codecs
+import select
+import time
 import ubinascii
+from mqtt_metrics import Metrics
+from topic_trie import TopicTrie
 from umqttsimple import MQTTClient
 
+_UNDECODABLE = object()
+
 
 class MQTTHandler:
-    def __init__(self, broker_address=None, broker_port=None, keepalive=None, client_id=None):
+    client_class = MQTTClient
+    RECONNECT_DELAY = 1  # Seconds, doubled after each failed attempt up to RECONNECT_DELAY_MAX
+    RECONNECT_DELAY_MAX = 60
+    OUTBOX_BATCH = 16  # Queued messages sent per batch when flushing the outbox
+
+    def __init__(self, broker_address=None, broker_port=None, keepalive=None, client_id=None, persistent=True, max_inflight=None, metrics_interval=None, outbox=None, queue=None, protocol=4, stream_threshold=None, ssl=False, ssl_params=None):
         self.broker_address = broker_address or '192.192.192.192'
-        self.broker_port = broker_port or 1883 # Default MQTT port
+        self.broker_port = broker_port or (8883 if ssl else 1883) # Default MQTT port
+        self.ssl = ssl # True (or an SSLContext) for TLS; the client keeps its context and session across reconnects
+        self.ssl_params = ssl_params # cadata, cert, key, cert_reqs, server_hostname
         self.keepalive = keepalive or 3600 # Defaults to 1 hour
         self.client_id = client_id or ubinascii.hexlify(machine.unique_id())
+        self.persistent = persistent # Keep the connection open between publishes
+        self.max_inflight = max_inflight or 1 # Unacknowledged QoS 1 messages allowed before publishing blocks
+        self.protocol = protocol # 5 for MQTT 5, which saves bytes on repeated topics with topic aliases
+        self.stream_threshold = stream_threshold # Payloads over this many bytes are received in chunks
         self.client = None
         self.subscriptions = {}
+        self.subscription_qos = {}
+        self.subscription_codecs = {}  # topic -> {callback: codec}
+        self._assembly = None  # A streamed payload being put together for codecs without feed()
+        self._topic_index = TopicTrie(key=lambda entry: entry[0])  # Entries are (callback, codec)
         self.connected = False
+        self.reconnects = 0
+        self._poller = None
+        self._last_tx = 0
+        self._ping_sent = None
+        self.metrics = Metrics()
+        # With an Outbox, publishes made while offline are stored and sent after reconnecting
+        self.outbox = outbox
+        # With a PublishQueue, messages wait for their priority class and rate limit
+        self.queue = queue
+        self._draining = False
+        self._retry_at = None
+        self._retry_delay = self.RECONNECT_DELAY
+        self.metrics_interval = metrics_interval # Seconds between publish_metrics() calls, None to never publish
+        self._next_metrics = time.ticks_add(time.ticks_ms(), metrics_interval * 1000) if metrics_interval else None
 
     @staticmethod
     def _ensure_connection():
         wlan = network.WLAN(network.STA_IF)
         while not wlan.isconnected():
-            pass
+            time.sleep_ms(100)
 
     def _message_callback(self, topic, payload):
         topic_str = topic.decode()
+        self.metrics.message_in(topic_str, len(payload))
+        # Decode lazily: not at all without a matching callback, and once per codec
+        codec = message = None
+        decoded = None  # Only needed when callbacks want different codecs
+        for callback, wanted in self._topic_index.match(topic_str):
+            if wanted is not codec:
+                if codec is not None:
+                    decoded = decoded or {}
+                    decoded[codec] = message
+                codec = wanted
+                if decoded and codec in decoded:
+                    message = decoded[codec]
+                else:
+                    try:
+                        message = codec.decode(payload)
+                    except Exception as e:
+                        print(f"Could not decode message on {topic_str}: {e}")
+                        message = _UNDECODABLE
+            if message is not _UNDECODABLE:
+                self._run_callback(callback, topic_str, message)
 
-        try:
+    def _stream_callback(self, topic, chunk, offset, total):
+        # A large message, a chunk at a time. Codecs that can feed on chunks get them as they
+        # come; the payload is only put together in memory when another codec needs it whole.
+        topic_str = topic.decode()
+        matches = self._topic_index.match(topic_str)
+        if not offset:
+            self.metrics.message_in(topic_str, total)
+            self._assembly = None
+        whole = False
+        for callback, codec in matches:
+            if not hasattr(codec, "feed"):
+                whole = True
+                continue
             try:
-                message = json.loads(payload.decode())
-            except Exception:
-                try:
-                    message = payload.decode()
-                except Exception:
-                    message = payload
-        except UnicodeDecodeError:
-            message = payload
-
-        if topic_str in self.subscriptions:
-            for callback in self.subscriptions[topic_str]:
+                message = codec.feed(topic_str, chunk, offset, total)
+            except Exception as e:
+                print(f"Could not decode message on {topic_str}: {e}")
+                continue
+            if message is not None:
+                self._run_callback(callback, topic_str, message)
+        if not whole:
+            return
+        if self._assembly is None:
+            self._assembly = bytearray(total)
+        self._assembly[offset:offset + len(chunk)] = chunk
+        if offset + len(chunk) < total:
+            return
+        payload = self._assembly
+        self._assembly = None
+        decoded = {}
+        for callback, codec in matches:
+            if hasattr(codec, "feed"):
+                continue
+            if codec not in decoded:
                 try:
-                    callback(topic_str, message)
+                    decoded[codec] = codec.decode(payload)
                 except Exception as e:
-                    print(f"Error in callback for topic {topic_str}: {e}")
+                    print(f"Could not decode message on {topic_str}: {e}")
+                    decoded[codec] = _UNDECODABLE
+            if decoded[codec] is not _UNDECODABLE:
+                self._run_callback(callback, topic_str, decoded[codec])
 
-        for pattern, callbacks in self.subscriptions.items():
-            if self._topic_matches_pattern(topic_str, pattern):
-                for callback in callbacks:
-                    try:
-                        callback(topic_str, message)
-                    except Exception as e:
-                        print(f"Error in wildcard callback for pattern {pattern}: {e}")
+    def _run_callback(self, callback, topic, message):
+        start = time.ticks_us()
+        failed = False
+        try:
+            callback(topic, message)
+        except Exception as e:
+            failed = True
+            print(f"Error in callback for topic {topic}: {e}")
+        self.metrics.callback_done(callback, time.ticks_diff(time.ticks_us(), start), failed)
 
-    @staticmethod
-    def _topic_matches_pattern(topic, pattern):
-        if pattern == topic:
+    def _create_client(self):
+        if self.client is None:
+            self.client = self.client_class(self.client_id, self.broker_address, broker_port=self.broker_port, keepalive=self.keepalive, max_inflight=self.max_inflight, protocol=self.protocol, ssl=self.ssl, ssl_params=self.ssl_params)
+            self.client.set_callback(self._message_callback)
+            if self.stream_threshold:
+                self.client.set_stream_callback(self._stream_callback, self.stream_threshold)
+            self.client.on_puback = self.metrics.ack
+
+    def _online(self):
+        # Without an outbox we wait for WiFi as before; with one we never block on it
+        if self.outbox is None:
+            self._ensure_connection()
             return True
-        if '+' in pattern or '#' in pattern:
-            pattern_parts = pattern.split('/')
-            topic_parts = topic.split('/')
-            if pattern.endswith('#'):
-                return topic.startswith(pattern[:-1])
-            if len(pattern_parts) != len(topic_parts):
-                return False
-            for p, t in zip(pattern_parts, topic_parts):
-                if p != '+' and p != t:
-                    return False
+        return network.WLAN(network.STA_IF).isconnected()
+
+    def try_connect(self, subscribe=True):
+        # Connect unless a recent attempt failed and its backoff hasn't passed yet; returns
+        # whether we are connected. Unlike connect() it doesn't raise when the broker is down.
+        if self.connected:
             return True
-        return False
+        if self._retry_at is not None and time.ticks_diff(self._retry_at, time.ticks_ms()) > 0:
+            return False
+        try:
+            if self._online():
+                self.connect(subscribe)
+        except OSError as e:
+            print(f"MQTT connect failed: {e}")
+        if self.connected:
+            self._retry_at = None
+            self._retry_delay = self.RECONNECT_DELAY
+        else:
+            self._retry_at = time.ticks_add(time.ticks_ms(), self._retry_delay * 1000)
+            self._retry_delay = min(self._retry_delay * 2, self.RECONNECT_DELAY_MAX)
+        return self.connected
 
-    def connect(self):
+    def connect(self, subscribe=True):
+        # subscribe=False is for a connection that only publishes and is closed right after
         if self.connected:
             return
         self._ensure_connection()
-        self.client = MQTTClient(self.client_id, self.broker_address, broker_port=self.broker_port, keepalive=self.keepalive)
-        self.client.set_callback(self._message_callback)
-        self.client.connect()
+        self._create_client()
+        # Reusing the client keeps its in-flight QoS 1 messages, which connect() resends
+        session_present = self.client.connect()
         self.connected = True
+        self._poller = select.poll()
+        self._poller.register(self.client.sock, select.POLLIN)
+        self._last_tx = time.ticks_ms()
+        self._ping_sent = None
+        # A new session has forgotten our subscriptions, so restore them
+        if subscribe and not session_present:
+            for topic, qos in self.subscription_qos.items():
+                self.client.subscribe(topic.encode(), qos)
+        self.flush_outbox()
+
+    def flush_outbox(self):
+        # Send what was stored while offline, oldest first, over the current connection.
+        # Records are only removed once a batch is acknowledged, so an outage halfway
+        # through sends some messages twice rather than losing them.
+        if not self.outbox or not self.connected:
+            return
+        while len(self.outbox):
+            messages, spanned = self.outbox.peek(self.OUTBOX_BATCH)
+            i = 0
+            while i < len(messages):
+                # publish_batch takes one retain/qos for all, so send runs of equal ones together
+                j = i + 1
+                while j < len(messages) and messages[j][2:] == messages[i][2:]:
+                    j += 1
+                self.client.publish_batch(((m[0], m[1]) for m in messages[i:j]), messages[i][2], messages[i][3])
+                i = j
+            self.client.wait_inflight()
+            self.outbox.remove(spanned)
+            for m in messages:
+                self.metrics.message_out(m[0].decode(), len(m[1]))
+            self._last_tx = time.ticks_ms()
+        print("Flushed the MQTT outbox")
 
     def disconnect(self):
         if self.client and self.connected:
-            self.client.disconnect()
+            try:
+                self.client.disconnect()
+            except OSError:
+                pass
             self.connected = False
 
-    def publish_message(self, topic, payload, retain=False, qos=0):
-        self._ensure_connection()
-        if isinstance(payload, (dict, list)):
-            payload = json.dumps(payload)
-        elif isinstance(payload, str):
-            payload = payload
-        else:
-            payload = str(payload)
+    def reconnect(self):
+        if self.client and self.connected:
+            try:
+                self.client.sock.close()
+            except OSError:
+                pass
+        self.connected = False
+        self.reconnects += 1
+        print("Reconnecting to MQTT broker...")
+        self.connect()
+
+    def _ping_interval_ms(self):
+        # Ping at half the keepalive so the broker never sees us idle for a full period.
+        # An MQTT 5 broker may have told the client to use a different keepalive.
+        keepalive = self.client.keepalive if self.client is not None else 0
+        return (keepalive or self.keepalive) * 500
+
+    def service_keepalive(self):
+        if not self.connected:
+            return
+        self.service_queue()
+        now = time.ticks_ms()
+        try:
+            if self._ping_sent is not None:
+                if self.client.ping_outstanding:
+                    self.client.check_msg()
+                if not self.client.ping_outstanding:
+                    self._ping_sent = None
+                elif time.ticks_diff(now, self._ping_sent) >= self._ping_interval_ms():
+                    print("No PINGRESP from MQTT broker, connection is half-open")
+                    self.reconnect()
+                return
+            if time.ticks_diff(now, self._last_tx) >= self._ping_interval_ms():
+                self.client.ping()
+                self._ping_sent = now
+                self._last_tx = now
+        except OSError:
+            self.reconnect()
+        if self._metrics_due():
+            self.publish_metrics()
+
+    def next_deadline_ms(self):
+        # Milliseconds until the handler needs servicing again: the next keepalive, queued
+        # send or metrics while connected, else the next reconnect attempt (None if none is planned)
+        if self.connected:
+            return self._next_keepalive_ms()
+        if self._retry_at is not None:
+            return max(0, time.ticks_diff(self._retry_at, time.ticks_ms()))
+        return None
+
+    def _next_keepalive_ms(self):
+        since = self._ping_sent if self._ping_sent is not None else self._last_tx
+        wait = max(0, self._ping_interval_ms() - time.ticks_diff(time.ticks_ms(), since))
+        if self._next_metrics is not None:
+            wait = min(wait, max(0, time.ticks_diff(self._next_metrics, time.ticks_ms())))
+        if self.queue is not None:
+            queued = self.queue.next_ready_ms()
+            if queued is not None:
+                wait = min(wait, queued)
+        return wait
+
+    def _metrics_due(self):
+        # Moves the deadline on before publishing, so publish_metrics() can't trigger itself
+        if self._next_metrics is None or time.ticks_diff(self._next_metrics, time.ticks_ms()) > 0:
+            return False
+        self._next_metrics = time.ticks_add(time.ticks_ms(), self.metrics_interval * 1000)
+        return True
+
+    def get_metrics(self):
+        metrics = self.metrics.snapshot()
+        metrics["reconnects"] = self.reconnects
+        metrics["inflight"] = len(self.client.inflight) if self.client else 0
+        metrics["deferred"] = len(self.client._deferred) if self.client else 0
+        if self.queue is not None:
+            metrics["queue"] = self.queue.stats()
+        return metrics
+
+    def publish_metrics(self, topic=None):
+        client_id = self.client_id.decode() if isinstance(self.client_id, bytes) else self.client_id
+        return self.publish_message(topic or f"status/{client_id}/metrics", self.get_metrics())
+
+    @staticmethod
+    def _encode_payload(payload, codec=None):
+        return payload_codecs.get(codec).encode(payload)
+
+    def publish_message(self, topic, payload, retain=False, qos=0, codec=None):
+        payload = self._encode_payload(payload, codec)
         if isinstance(topic, str):
             topic = topic.encode()
-        self.connect()
+        if self.queue is not None:
+            self.queue.put(topic, payload, retain, qos)
+            self.service_queue()
+            return
+        return self._send(topic, payload, retain, qos)
+
+    def service_queue(self):
+        # Send queued messages as far as their rate limits allow, most urgent first
+        if self.queue is None or self._draining:
+            return
+        self._draining = True  # _send() services the keepalive, which would get us here again
         try:
-            self.client.publish(topic, payload.encode(), retain=retain, qos=qos)
+            message = self.queue.pop()
+            while message is not None:
+                self._send(*message)
+                message = self.queue.pop()
         finally:
-            self.disconnect()
+            self._draining = False
+
+    def _send(self, topic, payload, retain, qos):
+        if self.outbox is not None:
+            return self._publish_or_store(topic, payload, retain, qos)
+        self._ensure_connection()
+        self.connect(self.persistent)
+        if not self.persistent:
+            try:
+                self.client.publish(topic, payload, retain=retain, qos=qos)
+                self.client.wait_inflight()
+            finally:
+                self.disconnect()
+            self.metrics.message_out(topic.decode(), len(payload))
+            return
+        self._check_link()
+        self.service_keepalive()
+        try:
+            self.client.publish(topic, payload, retain=retain, qos=qos)
+        except OSError:
+            self.reconnect()
+            # QoS 1 messages are still in flight and were resent by the reconnect
+            if not qos:
+                self.client.publish(topic, payload, retain=retain, qos=qos)
+        self._last_tx = time.ticks_ms()
+        self.metrics.message_out(topic.decode(), len(payload))
+
+    def _check_link(self):
+        # A QoS 0 message written into a connection the broker has already closed is lost
+        # without an error, so look before we write. A broker that hung up has left the
+        # socket readable at EOF. Anything else that is waiting is only buffered, not
+        # handled: callbacks run from wait_for_messages/check_messages, never inside a
+        # publish. A link that sent nothing for a whole keepalive may have been dropped
+        # silently along the way (by a NAT, say), so we replace it.
+        try:
+            if self.wait_socket(0):
+                self.client.read_ahead()
+        except OSError:
+            self.reconnect()
+            return
+        if time.ticks_diff(time.ticks_ms(), self._last_tx) >= 2 * self._ping_interval_ms():
+            print("MQTT connection idle for a whole keepalive, reconnecting")
+            self.reconnect()
+
+    def _publish_or_store(self, topic, payload, retain, qos):
+        # Returns True when the message went out, False when it was stored for later
+        sending = False
+        try:
+            if self.try_connect(self.persistent):
+                if self.persistent:
+                    self._check_link()
+                if len(self.outbox):
+                    self.flush_outbox()  # Keep the order: older stored messages first
+                sending = True
+                self.client.publish(topic, payload, retain=retain, qos=qos)
+                self._last_tx = time.ticks_ms()
+                if not self.persistent:
+                    self.client.wait_inflight()
+                    self.disconnect()
+                self.metrics.message_out(topic.decode(), len(payload))
+                return True
+        except OSError as e:
+            print(f"MQTT publish failed: {e}")
+            self.drop_connection()
+            if sending and qos and self.client.in_flight(payload):
+                return False  # Still in flight in the client, which resends it on reconnect
+        self.outbox.put(topic, payload, retain, qos)
+        self.metrics.message_stored()
+        return False
+
+    def drop_connection(self):
+        # Forget a connection that failed; the next try_connect() makes a new one
+        try:
+            self.client.sock.close()
+        except (AttributeError, OSError):
+            pass
+        self.connected = False
+
+    def wait_for_acks(self):
+        if not self.connected:
+            return
+        try:
+            self.client.wait_inflight()
+        except OSError:
+            self.reconnect()
+            self.client.wait_inflight()
 
     def publish_to_channel(self, topic="testes", payload="Hello world!", retain=False, qos=0):
-        self.publish_message(topic, payload, retain, qos)
+        return self.publish_message(topic, payload, retain, qos)
 
     def publish_sensor_data(self, sensor_name, data, retain=False, qos=0):
         payload = {
@@ -107,7 +419,7 @@ class MQTTHandler:
             "timestamp": machine.RTC().datetime()
         }
         topic = f"sensors/{sensor_name}"
-        self.publish_message(topic, payload, retain, qos)
+        return self.publish_message(topic, payload, retain, qos)
 
     def publish_status(self, device_name, status, retain=True, qos=0):
         payload = {
@@ -116,49 +428,93 @@ class MQTTHandler:
             "timestamp": machine.RTC().datetime()
         }
         topic = f"status/{device_name}"
-        self.publish_message(topic, payload, retain, qos)
+        return self.publish_message(topic, payload, retain, qos)
 
-    def subscribe(self, topic, callback, qos=0):
-        self.connect()
+    def _add_subscription(self, topic, callback, qos, codec=None):
+        if isinstance(topic, bytes):
+            topic = topic.decode()
+        codec = payload_codecs.get(codec)
         if topic not in self.subscriptions:
             self.subscriptions[topic] = []
+            self.subscription_codecs[topic] = {}
         self.subscriptions[topic].append(callback)
-        if isinstance(topic, str):
-            topic_bytes = topic.encode()
-        else:
-            topic_bytes = topic
-        self.client.subscribe(topic_bytes, qos)
+        self.subscription_codecs[topic][callback] = codec
+        self.subscription_qos[topic] = qos
+        self._topic_index.add(topic, (callback, codec))
+        return topic
 
-    def subscribe_to_topic(self, topic, callback, qos=0):
-        self.subscribe(topic, callback, qos)
+    def subscribe(self, topic, callback, qos=0, codec=None):
+        self.connect()
+        topic = self._add_subscription(topic, callback, qos, codec)
+        self.client.subscribe(topic.encode(), qos)
+        self._last_tx = time.ticks_ms()
 
-    def subscribe_to_sensor(self, sensor_name, callback, qos=0):
+    def subscribe_to_topic(self, topic, callback, qos=0, codec=None):
+        return self.subscribe(topic, callback, qos, codec)
+
+    def subscribe_to_sensor(self, sensor_name, callback, qos=0, codec=None):
         topic = f"sensors/{sensor_name}" if sensor_name else "sensors/+"
-        self.subscribe(topic, callback, qos)
+        return self.subscribe(topic, callback, qos, codec)
 
-    def subscribe_to_status(self, device_name, callback, qos=0):
+    def subscribe_to_status(self, device_name, callback, qos=0, codec=None):
         topic = f"status/{device_name}" if device_name else "status/+"
-        self.subscribe(topic, callback, qos)
+        return self.subscribe(topic, callback, qos, codec)
 
     def unsubscribe(self, topic, callback=None):
         if topic in self.subscriptions:
+            codecs = self.subscription_codecs[topic]
             if callback:
                 if callback in self.subscriptions[topic]:
+                    self._topic_index.remove(topic, (callback, codecs[callback]))
                     self.subscriptions[topic].remove(callback)
+                    if callback not in self.subscriptions[topic]:
+                        del codecs[callback]
                 if not self.subscriptions[topic]:
                     del self.subscriptions[topic]
+                    del self.subscription_qos[topic]
+                    del self.subscription_codecs[topic]
             else:
+                self._topic_index.remove(topic)
                 del self.subscriptions[topic]
+                del self.subscription_qos[topic]
+                del self.subscription_codecs[topic]
+
+    def wait_socket(self, timeout_ms):
+        # Block until there is something to read or timeout_ms has passed
+        if self.client.buffered():
+            return True
+        if hasattr(self._poller, "ipoll"):
+            for _ in self._poller.ipoll(timeout_ms):
+                return True  # ipoll doesn't allocate a result list
+            return False
+        return bool(self._poller.poll(timeout_ms))
+
+    def read_buffered(self):
+        # Handle one packet and everything else that arrived with it
+        self.client.wait_msg()
+        while self.client.buffered():
+            self.client.wait_msg()
 
     def wait_for_messages(self):
         if not self.connected:
             raise Exception("Not connected to MQTT broker")
         try:
             while True:
-                self.client.wait_msg()
+                try:
+                    if self.wait_socket(self._next_keepalive_ms()):
+                        self.read_buffered()
+                except OSError:
+                    self.reconnect()
+                    continue
+                self.service_keepalive()
         except KeyboardInterrupt:
             print("Stopping message listener...")
 
     def check_messages(self):
         if self.connected:
-            self.client.check_msg()
+            try:
+                self.client.check_msg()
+            except OSError:
+                self.reconnect()
+                return
+            self.service_keepalive()
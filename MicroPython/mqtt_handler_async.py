@@ -0,0 +1,232 @@
+# mqtt_handler_async.py
+
+# asyncio (uasyncio) flavour of MQTTHandler. All network methods are coroutines; the
+# convenience wrappers (publish_sensor_data, subscribe_to_topic, ...) are inherited and
+# return those coroutines, so they are awaited the same way.
+#
+#   handler = AsyncMQTTHandler('192.168.1.170')
+#   asyncio.create_task(handler.run())
+#   await handler.subscribe_to_topic('testes', on_message)
+#   await handler.publish_sensor_data('humidity', {'value': 50})
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+import network
+import time
+
+import umqttasync
+from mqtt_handler import MQTTHandler
+
+
+class AsyncMQTTHandler(MQTTHandler):
+    client_class = umqttasync.MQTTClient
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._connect_lock = asyncio.Lock()
+        self._queued = asyncio.Event()  # Set when publish_message() adds to the queue
+        self._up = asyncio.Event()  # Set while connected; publishers wait on it while run() reconnects
+        self._running = False  # run() is going and does all reconnecting
+        self._closing = False  # Only set by disconnect(), which makes run() return
+
+    @staticmethod
+    async def _ensure_connection():
+        wlan = network.WLAN(network.STA_IF)
+        while not wlan.isconnected():
+            await asyncio.sleep(0.1)
+
+    def _run_callback(self, callback, topic, message):
+        start = time.ticks_us()
+        try:
+            res = callback(topic, message)
+        except Exception as e:
+            print(f"Error in callback for topic {topic}: {e}")
+            self.metrics.callback_done(callback, time.ticks_diff(time.ticks_us(), start), True)
+            return
+        if hasattr(res, "send"):
+            asyncio.create_task(self._guard(res, callback, topic, start))
+        else:
+            self.metrics.callback_done(callback, time.ticks_diff(time.ticks_us(), start))
+
+    async def _guard(self, coro, callback, topic, start):
+        # Coroutine callbacks are timed until they finish, including time spent awaiting
+        failed = False
+        try:
+            await coro
+        except Exception as e:
+            failed = True
+            print(f"Error in callback for topic {topic}: {e}")
+        self.metrics.callback_done(callback, time.ticks_diff(time.ticks_us(), start), failed)
+
+    async def connect(self):
+        async with self._connect_lock:
+            if self.client is not None and self.client.connected:
+                self.connected = True
+                return
+            await self._ensure_connection()
+            self._create_client()
+            session_present = await self.client.connect()
+            self.connected = True
+            # A new session has forgotten our subscriptions, so restore them
+            if not session_present:
+                for topic, qos in self.subscription_qos.items():
+                    await self.client.subscribe(topic.encode(), qos)
+            self._up.set()
+            await self.flush_outbox()
+
+    async def _wait_connected(self):
+        # With run() going we leave the (re)connecting to it; without it we connect ourselves
+        if self._running:
+            await self._up.wait()
+        else:
+            await self.connect()
+
+    async def flush_outbox(self):
+        if not self.outbox or not self.connected:
+            return
+        while len(self.outbox):
+            messages, spanned = self.outbox.peek(self.OUTBOX_BATCH)
+            for topic, msg, retain, qos in messages:
+                await self.client.publish(topic, msg, retain=retain, qos=qos)
+            await self.client.wait_inflight()
+            self.outbox.remove(spanned)
+            for topic, msg, retain, qos in messages:
+                self.metrics.message_out(topic.decode(), len(msg))
+        print("Flushed the MQTT outbox")
+
+    async def disconnect(self):
+        self._closing = True
+        self.connected = False
+        self._up.clear()
+        if self.client and self.client.connected:
+            await self.client.disconnect()
+
+    async def reconnect(self):
+        # Drop the old link first, so connect() doesn't take a client that failed a write
+        # for a live one. run() notices it closing and reconnects; we wait for that.
+        self.connected = False
+        self._up.clear()
+        if self.client is not None:
+            self.client.close()
+        if self._running:
+            await self._up.wait()
+            return
+        self.reconnects += 1
+        print("Reconnecting to MQTT broker...")
+        await self.connect()
+
+    async def run(self):
+        # Keep the connection up: connect, wait for it to drop, reconnect with backoff
+        metrics_task = asyncio.create_task(self._metrics_loop()) if self.metrics_interval else None
+        queue_task = asyncio.create_task(self._queue_loop()) if self.queue is not None else None
+        delay = self.RECONNECT_DELAY
+        self._closing = False
+        self._running = True
+        try:
+            while not self._closing:
+                try:
+                    await self.connect()
+                    delay = self.RECONNECT_DELAY
+                    await self.client.wait_closed()
+                    self.connected = False
+                    self._up.clear()
+                    if self._closing:
+                        return  # disconnect() was called
+                    self.reconnects += 1
+                    print("Reconnecting to MQTT broker...")
+                except (OSError, EOFError) as e:  # EOFError: the broker hung up mid-handshake
+                    print(f"MQTT connect failed: {e!r}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.RECONNECT_DELAY_MAX)
+        finally:
+            self._running = False
+            if metrics_task is not None:
+                metrics_task.cancel()
+            if queue_task is not None:
+                queue_task.cancel()
+
+    async def _metrics_loop(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            if self.connected:
+                try:
+                    await self.publish_metrics()
+                except OSError as e:
+                    print(f"Publishing metrics failed: {e}")
+
+    async def _queue_loop(self):
+        # Send queued messages as their rate limits allow; a new message wakes us early,
+        # so an urgent one doesn't wait for a telemetry token
+        while True:
+            message = self.queue.pop()
+            if message is not None:
+                try:
+                    await self._send(*message)
+                except OSError as e:
+                    print(f"MQTT publish failed: {e}")
+                continue
+            wait = self.queue.next_ready_ms()
+            self._queued.clear()
+            try:
+                if wait is None:
+                    await self._queued.wait()
+                else:
+                    await asyncio.wait_for(self._queued.wait(), wait / 1000)
+            except asyncio.TimeoutError:
+                pass
+
+    async def publish_message(self, topic, payload, retain=False, qos=0, codec=None):
+        payload = self._encode_payload(payload, codec)
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if self.queue is not None:
+            # run() sends it from its queue task
+            self.queue.put(topic, payload, retain, qos)
+            self._queued.set()
+            return
+        return await self._send(topic, payload, retain, qos)
+
+    async def _send(self, topic, payload, retain, qos):
+        if self.outbox is not None:
+            # Don't wait for the connection; run() reconnects and flushes the outbox
+            if self.connected and self.client.connected and not len(self.outbox):
+                try:
+                    await self.client.publish(topic, payload, retain=retain, qos=qos)
+                    self.metrics.message_out(topic.decode(), len(payload))
+                    return True
+                except OSError as e:
+                    print(f"MQTT publish failed: {e}")
+                    if qos and self.client.in_flight(payload):
+                        return False  # Still in flight in the client, which resends it on reconnect
+            self.outbox.put(topic, payload, retain, qos)
+            self.metrics.message_stored()
+            return False
+        await self._wait_connected()
+        try:
+            await self.client.publish(topic, payload, retain=retain, qos=qos)
+        except OSError:
+            recorded = qos and self.client.in_flight(payload)
+            await self.reconnect()
+            # A QoS 1 message the client recorded was resent by the reconnect
+            if not recorded:
+                await self.client.publish(topic, payload, retain=retain, qos=qos)
+        self.metrics.message_out(topic.decode(), len(payload))
+
+    async def wait_for_acks(self):
+        if self.connected:
+            await self.client.wait_inflight()
+
+    async def subscribe(self, topic, callback, qos=0, codec=None):
+        topic = self._add_subscription(topic, callback, qos, codec)
+        if self.connected and self.client.connected:
+            await self.client.subscribe(topic.encode(), qos)
+        elif not self._running:
+            await self.connect()  # Otherwise run() subscribes when it has reconnected
+
+    async def wait_for_messages(self):
+        await self.run()
+
+    def check_messages(self):
+        pass  # Incoming messages are handled by the client's reader task
@@ -0,0 +1,102 @@
+# mqtt_metrics.py
+
+# Fixed-size counters and histograms for MQTTHandler. Everything is plain ints in
+# preallocated lists so recording a sample never allocates on the microcontroller.
+
+ACK_LATENCY_BUCKETS_MS = (5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+CALLBACK_BUCKETS_US = (100, 500, 1000, 5000, 10000, 50000, 100000, 500000)
+
+
+class Histogram:
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last bucket holds everything above the top bound
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        i = 0
+        bounds = self.bounds
+        while i < len(bounds) and value > bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return {
+            "buckets": self.bounds,
+            "counts": self.counts,
+            "count": self.count,
+            "mean": self.total // self.count if self.count else 0,
+            "max": self.max,
+        }
+
+
+class Metrics:
+
+    def __init__(self, max_topics=16):
+        self.max_topics = max_topics  # Topics beyond this are counted under "other"
+        self.messages_in = 0
+        self.messages_out = 0
+        self.messages_stored = 0  # Written to the outbox instead of sent; counted out when flushed
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.callback_errors = 0
+        self.topics_in = {}
+        self.topics_out = {}
+        self.ack_latency_ms = Histogram(ACK_LATENCY_BUCKETS_MS)
+        self.callback_us = Histogram(CALLBACK_BUCKETS_US)
+        self.slowest_callbacks = {}  # Callback name -> longest run in us
+
+    def _count_topic(self, topics, topic):
+        if topic in topics:
+            topics[topic] += 1
+        elif len(topics) < self.max_topics:
+            topics[topic] = 1
+        else:
+            topics["other"] = topics.get("other", 0) + 1
+
+    def message_in(self, topic, size):
+        self.messages_in += 1
+        self.bytes_in += size
+        self._count_topic(self.topics_in, topic)
+
+    def message_out(self, topic, size):
+        self.messages_out += 1
+        self.bytes_out += size
+        self._count_topic(self.topics_out, topic)
+
+    def message_stored(self):
+        self.messages_stored += 1
+
+    def ack(self, pid, latency_ms):
+        self.ack_latency_ms.add(latency_ms)
+
+    def callback_done(self, callback, elapsed_us, failed=False):
+        self.callback_us.add(elapsed_us)
+        if failed:
+            self.callback_errors += 1
+        name = getattr(callback, "__name__", "callback")
+        if elapsed_us > self.slowest_callbacks.get(name, -1):
+            if name in self.slowest_callbacks or len(self.slowest_callbacks) < self.max_topics:
+                self.slowest_callbacks[name] = elapsed_us
+
+    def snapshot(self):
+        return {
+            "messages_in": self.messages_in,
+            "messages_out": self.messages_out,
+            "messages_stored": self.messages_stored,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "callback_errors": self.callback_errors,
+            "topics_in": self.topics_in,
+            "topics_out": self.topics_out,
+            "ack_latency_ms": self.ack_latency_ms.snapshot(),
+            "callback_us": self.callback_us.snapshot(),
+            "slowest_callbacks": self.slowest_callbacks,
+        }
@@ -3,6 +3,8 @@
 import time
 
 from mqtt_handler import MQTTHandler
+from scheduler import Scheduler
+from sensor_batcher import AGGREGATE, SensorBatcher
 
 
 class MQTTUsageExamples:
@@ -62,6 +64,25 @@ class MQTTUsageExamples:
 
         return mqtt_handler
 
+    def example_batched_sensor(self):
+        """Example of sending many sensor readings per message with SensorBatcher"""
+        mqtt_handler = MQTTHandler(broker_address=self.broker_ip)
+
+        # Up to 20 humidity readings per message, sent at least every 5 seconds
+        batcher = SensorBatcher(mqtt_handler, max_samples=20, max_age_ms=5000)
+
+        # For temperature only min/max/mean/last per window is sent
+        batcher.configure('temperature', mode=AGGREGATE)
+
+        for i in range(50):
+            batcher.add('humidity', 50 + i % 5)
+            batcher.add('temperature', 20.5 + i / 10)
+            batcher.service()
+            time.sleep(0.1)
+
+        batcher.flush()  # Send whatever is still buffered
+        return mqtt_handler
+
     def run_demo(self):
         """
         Run a short demonstration showing publisher and subscriber working together.
@@ -82,9 +103,7 @@ class MQTTUsageExamples:
 
         # Give time for messages to be processed
         print("⏳ Processing messages...")
-        for i in range(5):
-            subscriber.check_messages()
-            time.sleep(0.5)
+        Scheduler(subscriber).run(duration_ms=2500)
 
         print("✅ Demo completed!")
         print("-" * 40)
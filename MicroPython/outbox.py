@@ -0,0 +1,182 @@
+# outbox.py
+
+# Store-and-forward queue for messages that could not be published. Messages go into a
+# fixed-size ring file on flash, so an outage costs neither RAM nor data: when the file
+# is full the oldest messages are overwritten.
+#
+# File layout: a 16 byte header (magic, head, tail, count), then records of
+#   flags (1 byte) | topic length (2) | message length (2) | topic | message
+# A record never wraps around the end of the file; the writer marks the unused tail
+# with a WRAP byte (or leaves fewer than RECORD_HEADER bytes) and continues at the start.
+
+import os
+
+import ustruct as struct
+
+OLDEST_FIRST = "oldest-first"  # Keep every message, drop the oldest when full
+LATEST_PER_TOPIC = "latest-per-topic"  # Only keep the newest message for each topic
+
+MAGIC = b"OBX1"
+HEADER = 16
+RECORD_HEADER = 5
+RETAIN = 0x01
+QOS1 = 0x02
+DELETED = 0x40  # Superseded by a newer message on the same topic
+WRAP = 0xff
+
+
+class Outbox:
+
+    def __init__(self, path="outbox.bin", size=16384, policy=OLDEST_FIRST):
+        if policy not in (OLDEST_FIRST, LATEST_PER_TOPIC):
+            raise ValueError(f"Unknown outbox policy: {policy}")
+        self.path = path
+        self.size = size
+        self.policy = policy
+        self.dropped = 0
+        self._hdr = bytearray(HEADER)
+        self._rec = bytearray(RECORD_HEADER)
+        self._latest = {}  # topic -> offset of its newest record, for LATEST_PER_TOPIC
+        self._open()
+
+    def _open(self):
+        try:
+            fresh = os.stat(self.path)[6] != self.size
+        except OSError:
+            fresh = True
+        if not fresh:
+            self._f = open(self.path, "r+b")
+            self._f.readinto(self._hdr)
+            magic, self.head, self.tail, self.count = struct.unpack("<4sIII", self._hdr)
+            fresh = magic != MAGIC
+            if not fresh and self.policy == LATEST_PER_TOPIC:
+                for pos, flags, topic, msg in self._records():
+                    self._supersede(topic, pos)
+            if fresh:
+                self._f.close()
+        if fresh:
+            # Write the whole file once so later writes never have to grow it
+            with open(self.path, "wb") as f:
+                zeros = bytes(256)
+                for _ in range(self.size // 256):
+                    f.write(zeros)
+                f.write(bytes(self.size % 256))
+            self._f = open(self.path, "r+b")
+            self.head = self.tail = HEADER
+            self.count = 0
+            self._write_header()
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._f.close()
+
+    def _write_header(self):
+        struct.pack_into("<4sIII", self._hdr, 0, MAGIC, self.head, self.tail, self.count)
+        self._f.seek(0)
+        self._f.write(self._hdr)
+        self._f.flush()
+
+    def _read_record(self, pos):
+        # Returns (pos, flags, topic_len, msg_len) for the record at or after a wrap at pos
+        if pos + RECORD_HEADER > self.size:
+            pos = HEADER
+        self._f.seek(pos)
+        self._f.readinto(self._rec)
+        if self._rec[0] == WRAP:
+            pos = HEADER
+            self._f.seek(pos)
+            self._f.readinto(self._rec)
+        flags, topic_len, msg_len = struct.unpack("<BHH", self._rec)
+        return pos, flags, topic_len, msg_len
+
+    def _records(self):
+        pos = self.head
+        for _ in range(self.count):
+            pos, flags, topic_len, msg_len = self._read_record(pos)
+            topic = self._f.read(topic_len)
+            msg = self._f.read(msg_len)
+            yield pos, flags, topic, msg
+            pos += RECORD_HEADER + topic_len + msg_len
+
+    def _pop_head(self):
+        pos, flags, topic_len, msg_len = self._read_record(self.head)
+        if self.policy == LATEST_PER_TOPIC and not flags & DELETED:
+            self._f.seek(pos + RECORD_HEADER)
+            topic = self._f.read(topic_len)
+            if self._latest.get(topic) == pos:
+                del self._latest[topic]
+        self.head = pos + RECORD_HEADER + topic_len + msg_len
+        self.count -= 1
+        if not self.count:
+            self.head = self.tail = HEADER
+        return flags
+
+    def _space_at_tail(self, n):
+        # Where a record of n bytes can go without overwriting queued data, or None
+        wrapped = self.tail < self.head or (self.tail == self.head and self.count)
+        if not wrapped:
+            if self.tail + n <= self.size:
+                return self.tail
+            if HEADER + n <= self.head:
+                return HEADER
+            return None
+        return self.tail if self.tail + n <= self.head else None
+
+    def _supersede(self, topic, pos):
+        old = self._latest.get(topic)
+        if old is not None:
+            self._f.seek(old)
+            flags = self._f.read(1)[0]
+            self._f.seek(old)
+            self._f.write(bytes((flags | DELETED,)))
+        self._latest[topic] = pos
+
+    def put(self, topic, msg, retain=False, qos=0):
+        n = RECORD_HEADER + len(topic) + len(msg)
+        if n > self.size - HEADER:
+            print(f"Message on {topic} is too large for the outbox, dropped")
+            self.dropped += 1
+            return False
+        pos = self._space_at_tail(n)
+        if pos is None:
+            while pos is None:
+                if not self._pop_head() & DELETED:
+                    self.dropped += 1
+                pos = self._space_at_tail(n)
+            # Commit the new head before its old records get overwritten
+            self._write_header()
+        if pos != self.tail and self.tail + RECORD_HEADER <= self.size:
+            self._f.seek(self.tail)
+            self._f.write(bytes((WRAP,)))
+        struct.pack_into("<BHH", self._rec, 0, (RETAIN if retain else 0) | (QOS1 if qos else 0), len(topic), len(msg))
+        self._f.seek(pos)
+        self._f.write(self._rec)
+        self._f.write(topic)
+        self._f.write(msg)
+        if self.policy == LATEST_PER_TOPIC:
+            self._supersede(topic, pos)
+        self.tail = pos + n
+        self.count += 1
+        self._write_header()
+        return True
+
+    def peek(self, limit):
+        # Up to `limit` of the oldest records as (topic, msg, retain, qos), and how many
+        # records they span (superseded ones are skipped but still have to be removed)
+        out = []
+        spanned = 0
+        for pos, flags, topic, msg in self._records():
+            if len(out) >= limit:
+                break
+            spanned += 1
+            if not flags & DELETED:
+                out.append((topic, msg, bool(flags & RETAIN), 1 if flags & QOS1 else 0))
+        return out, spanned
+
+    def remove(self, n):
+        # Forget the n oldest records once they have been published
+        for _ in range(min(n, self.count)):
+            self._pop_head()
+        self._write_header()
@@ -0,0 +1,173 @@
+# payload_codecs.py
+
+# Payload codecs for MQTTHandler. A subscription names the codec its callback wants,
+# and a message is only decoded when a callback for its topic exists, once per codec.
+# publish_message uses the same codecs to turn values into bytes.
+#
+#   handler.subscribe('sensors/raw', on_raw, codec='raw')
+#   handler.subscribe('sensors/adc', on_adc, codec=Struct('<HH'))
+#   handler.subscribe('firmware/blob', on_firmware, codec=File('firmware.bin'))
+#   register('csv', MyCsvCodec())
+#
+# Codecs with a feed() method can take a payload in pieces. MQTTHandler(stream_threshold=...)
+# hands them messages bigger than the threshold a chunk at a time, so those never have to
+# fit in memory. Other codecs still get such payloads whole.
+
+import json
+import os
+
+import ustruct as struct
+
+
+class Raw:
+    # The payload as received. With MQTTClient(zero_copy=True) this is a memoryview
+    # that is only valid while the callback runs.
+
+    def decode(self, payload):
+        return payload
+
+    def encode(self, value):
+        return value
+
+
+class Utf8:
+
+    def decode(self, payload):
+        return str(payload, "utf-8")
+
+    def encode(self, value):
+        return value.encode()
+
+
+class Json:
+
+    def decode(self, payload):
+        return json.loads(str(payload, "utf-8"))
+
+    def encode(self, value):
+        return json.dumps(value).encode()
+
+
+class Struct:
+    # Fixed binary layouts, decoded to a tuple with ustruct
+
+    def __init__(self, fmt):
+        self.fmt = fmt
+
+    def decode(self, payload):
+        return struct.unpack(self.fmt, payload)
+
+    def encode(self, value):
+        if isinstance(value, (tuple, list)):
+            return struct.pack(self.fmt, *value)
+        return struct.pack(self.fmt, value)
+
+
+class Chunks:
+    # The callback gets (chunk, offset, total) for every piece of the payload as it arrives,
+    # and payloads below the stream threshold as a single chunk. chunk is only valid while
+    # the callback runs.
+
+    def decode(self, payload):
+        return payload, 0, len(payload)
+
+    def feed(self, topic, chunk, offset, total):
+        return chunk, offset, total
+
+    def encode(self, value):
+        return value
+
+
+class File:
+    # Writes the payload to a file and hands the callback its path once it is complete.
+    # Streamed payloads go to path + '.part' first, so a broken transfer never replaces
+    # the previous file.
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def decode(self, payload):
+        with open(self.path, "wb") as f:
+            f.write(payload)
+        return self.path
+
+    def feed(self, topic, chunk, offset, total):
+        if not offset:
+            if self._file is not None:
+                self._file.close()  # The previous transfer was cut off
+            self._file = open(self.path + ".part", "wb")
+        self._file.write(chunk)
+        if offset + len(chunk) < total:
+            return None
+        self._file.close()
+        self._file = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        os.rename(self.path + ".part", self.path)
+        return self.path
+
+    def encode(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+
+class Auto:
+    # What MQTTHandler always did: JSON if it parses, else text, else bytes. Only payloads
+    # that can start a JSON value are handed to the parser, so plain text doesn't cost an
+    # exception per message.
+    JSON_START = set(b'{["-0123456789tfn')
+
+    def decode(self, payload):
+        if len(payload) and payload[0] in self.JSON_START:
+            try:
+                return json.loads(str(payload, "utf-8"))
+            except ValueError:
+                pass
+        try:
+            return str(payload, "utf-8")
+        except UnicodeError:
+            return payload
+
+    def encode(self, value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return value
+        if isinstance(value, str):
+            return value.encode()
+        if isinstance(value, (dict, list)):
+            return json.dumps(value).encode()
+        return str(value).encode()
+
+
+RAW = Raw()
+UTF8 = Utf8()
+JSON = Json()
+AUTO = Auto()
+CHUNKS = Chunks()
+
+CODECS = {
+    "raw": RAW,
+    "utf-8": UTF8,
+    "json": JSON,
+    "auto": AUTO,
+    "chunks": CHUNKS,
+}
+
+
+def register(name, codec):
+    # codec is anything with decode(payload) and encode(value) methods
+    CODECS[name] = codec
+
+
+def get(codec):
+    # Look up a codec by name; codec objects are passed through and None means AUTO
+    if codec is None:
+        return AUTO
+    if isinstance(codec, str):
+        try:
+            return CODECS[codec]
+        except KeyError:
+            raise ValueError(f"Unknown payload codec: {codec}")
+    return codec
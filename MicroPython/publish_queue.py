@@ -0,0 +1,118 @@
+# publish_queue.py
+
+# Outbound queue for MQTTHandler with priority classes. A topic belongs to the first class
+# with a matching prefix, and waiting messages are sent from the most urgent class first.
+# Each class can be held to a rate by a token bucket, so a burst of telemetry is spread
+# out instead of filling the socket (or tripping a broker's rate limit) ahead of a
+# doorbell press. In a 'latest' class a newer message for a topic replaces the one that is
+# still waiting, since only the latest reading matters.
+#
+#   handler = MQTTHandler('192.168.1.170', queue=PublishQueue())
+#   handler.publish_sensor_data('humidity', {'value': 50})  # at most 5 per second
+#   handler.publish_to_channel('doorbell', {'Message': 'Doorbell pressed!'})  # goes first
+#
+# publish_message() and service_keepalive() send whatever the rate limits allow, so
+# wait_for_messages() or a Scheduler keeps the queue moving.
+
+import time
+
+
+class PriorityClass:
+
+    def __init__(self, name, prefixes, rate=None, burst=1, latest=False, max_queued=32):
+        self.name = name
+        self.prefixes = [p.encode() if isinstance(p, str) else p for p in prefixes]
+        self.rate = rate  # Messages per second, None for no limit
+        self.burst = burst  # Messages that may go out back to back after a quiet spell
+        self.latest = latest  # A newer message for a waiting topic replaces it
+        self.max_queued = max_queued  # Beyond this the oldest waiting message is dropped
+        self.waiting = []  # [topic, payload, retain, qos], oldest first
+        self.tokens = burst
+        self._refilled = time.ticks_ms()
+        self.sent = 0
+        self.dropped = 0
+        self.superseded = 0
+
+    def matches(self, topic):
+        for prefix in self.prefixes:
+            if topic.startswith(prefix):
+                return True
+        return False
+
+    def ready_in_ms(self, now):
+        # Milliseconds until the bucket has a token, 0 if it has one now
+        if self.rate is None:
+            return 0
+        self.tokens = min(self.burst, self.tokens + time.ticks_diff(now, self._refilled) * self.rate / 1000)
+        self._refilled = now
+        if self.tokens >= 1:
+            return 0
+        return int((1 - self.tokens) * 1000 / self.rate) + 1
+
+
+def default_classes():
+    # Doorbell and alarms first and never held back, then device status, then sensor
+    # readings (rate limited, latest value wins), then everything else (not rate limited)
+    return [
+        PriorityClass("alarm", ("doorbell", "alarm/")),
+        PriorityClass("status", ("status/",)),
+        PriorityClass("telemetry", ("sensors/",), rate=5, burst=10, latest=True),
+        PriorityClass("other", ("",)),
+    ]
+
+
+class PublishQueue:
+
+    def __init__(self, classes=None):
+        self.classes = classes or default_classes()  # Most urgent first
+
+    def classify(self, topic):
+        for cls in self.classes:
+            if cls.matches(topic):
+                return cls
+        return self.classes[-1]
+
+    def put(self, topic, payload, retain=False, qos=0):
+        cls = self.classify(topic)
+        if cls.latest:
+            for message in cls.waiting:
+                if message[0] == topic:
+                    message[1] = payload
+                    message[2] = retain
+                    message[3] = qos
+                    cls.superseded += 1
+                    return cls
+        if len(cls.waiting) >= cls.max_queued:
+            cls.waiting.pop(0)
+            cls.dropped += 1
+        cls.waiting.append([topic, payload, retain, qos])
+        return cls
+
+    def pop(self):
+        # The next message that may be sent now as (topic, payload, retain, qos), or None.
+        # A class that is out of tokens doesn't hold up the ones below it.
+        now = time.ticks_ms()
+        for cls in self.classes:
+            if cls.waiting and not cls.ready_in_ms(now):
+                if cls.rate is not None:
+                    cls.tokens -= 1
+                cls.sent += 1
+                return tuple(cls.waiting.pop(0))
+        return None
+
+    def next_ready_ms(self):
+        # Milliseconds until pop() has something, or None when nothing is waiting
+        now = time.ticks_ms()
+        wait = None
+        for cls in self.classes:
+            if cls.waiting:
+                left = cls.ready_in_ms(now)
+                wait = left if wait is None else min(wait, left)
+        return wait
+
+    def __len__(self):
+        return sum(len(cls.waiting) for cls in self.classes)
+
+    def stats(self):
+        return {cls.name: {"queued": len(cls.waiting), "sent": cls.sent, "dropped": cls.dropped,
+                           "superseded": cls.superseded} for cls in self.classes}
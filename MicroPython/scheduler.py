@@ -0,0 +1,135 @@
+# scheduler.py
+
+# Event loop for MQTTHandler that sleeps instead of spinning. It blocks in select.poll on
+# the MQTT socket until a message arrives, the keepalive is due or one of its periodic
+# tasks has to run, whichever comes first.
+#
+# With lightsleep=True the CPU is put in machine.lightsleep between deadlines once
+# traffic has been quiet for a while. The socket can't wake it, so incoming messages
+# are only picked up when it wakes: the quieter it gets, the longer it sleeps (up to
+# max_sleep_ms), and any message brings it back to polling right away.
+#
+#   scheduler = Scheduler(mqtt_handler, lightsleep=True)
+#   scheduler.every(5000, read_sensors)
+#   scheduler.run()
+
+import time
+
+import machine
+
+
+class _Task:
+    __slots__ = ("due", "interval", "fn")
+
+    def __init__(self, due, interval, fn):
+        self.due = due
+        self.interval = interval
+        self.fn = fn
+
+
+class Scheduler:
+
+    def __init__(self, handler, lightsleep=False, min_sleep_ms=50, max_sleep_ms=30000, awake_ms=2000):
+        self.handler = handler
+        self.lightsleep = lightsleep
+        self.min_sleep_ms = min_sleep_ms  # Shortest lightsleep worth taking, and the first one after traffic
+        self.max_sleep_ms = max_sleep_ms  # Longest lightsleep, reached by doubling while quiet
+        self.awake_ms = awake_ms  # Stay in poll after a message, since bursts tend to follow
+        self.tasks = []
+        self._sleep_ms = min_sleep_ms
+        self._last_activity = time.ticks_ms()
+        self._running = False
+
+    def every(self, interval_ms, fn):
+        task = _Task(time.ticks_add(time.ticks_ms(), interval_ms), interval_ms, fn)
+        self.tasks.append(task)
+        return task
+
+    def after(self, delay_ms, fn):
+        task = _Task(time.ticks_add(time.ticks_ms(), delay_ms), None, fn)
+        self.tasks.append(task)
+        return task
+
+    def cancel(self, task):
+        if task in self.tasks:
+            self.tasks.remove(task)
+
+    def stop(self):
+        self._running = False
+
+    def _run_due(self, now):
+        for task in list(self.tasks):
+            if time.ticks_diff(task.due, now) > 0:
+                continue
+            if task.interval is None:
+                self.tasks.remove(task)
+            else:
+                # Skip missed runs rather than firing them back to back
+                task.due = time.ticks_add(task.due, task.interval)
+                if time.ticks_diff(task.due, now) <= 0:
+                    task.due = time.ticks_add(now, task.interval)
+            try:
+                task.fn()
+            except Exception as e:
+                print(f"Error in scheduled task: {e}")
+
+    def _next_deadline_ms(self, now):
+        wait = self.handler.next_deadline_ms()
+        if wait is None:
+            wait = self.max_sleep_ms
+        for task in self.tasks:
+            wait = min(wait, max(0, time.ticks_diff(task.due, now)))
+        return wait
+
+    def _activity(self, now):
+        self._last_activity = now
+        self._sleep_ms = self.min_sleep_ms
+
+    def run_once(self, limit_ms=None):
+        # Wait for the next event, handle it and return
+        handler = self.handler
+        now = time.ticks_ms()
+        if not handler.connected:
+            handler.try_connect()
+        wait = self._next_deadline_ms(now)
+        if limit_ms is not None:
+            wait = min(wait, limit_ms)
+        quiet = time.ticks_diff(now, self._last_activity) >= self.awake_ms
+        received = handler.metrics.messages_in
+        try:
+            if handler.connected and self.lightsleep and quiet and wait >= self.min_sleep_ms:
+                machine.lightsleep(min(wait, self._sleep_ms))
+                self._sleep_ms = min(self._sleep_ms * 2, self.max_sleep_ms)
+                while handler.wait_socket(0):
+                    handler.read_buffered()
+            elif handler.connected:
+                if handler.wait_socket(wait):
+                    handler.read_buffered()
+            else:
+                time.sleep_ms(min(wait, self.max_sleep_ms))
+        except OSError as e:
+            print(f"MQTT connection lost: {e}")
+            handler.drop_connection()  # The next round reconnects, with backoff
+        if handler.metrics.messages_in != received:
+            self._activity(time.ticks_ms())
+        self._run_due(time.ticks_ms())
+        try:
+            handler.service_keepalive()
+        except OSError as e:
+            print(f"MQTT reconnect failed: {e}")
+            handler.drop_connection()
+
+    def run(self, duration_ms=None):
+        self._running = True
+        start = time.ticks_ms()
+        try:
+            while self._running:
+                left = None
+                if duration_ms is not None:
+                    left = duration_ms - time.ticks_diff(time.ticks_ms(), start)
+                    if left <= 0:
+                        break
+                self.run_once(left)
+        except KeyboardInterrupt:
+            print("Stopping scheduler...")
+        self._running = False
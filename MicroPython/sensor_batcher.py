@@ -0,0 +1,219 @@
+# sensor_batcher.py
+
+# Buffers sensor readings and publishes many of them as one message, instead of one
+# message per reading the way MQTTHandler.publish_sensor_data does.
+#
+#   batcher = SensorBatcher(mqtt_handler, max_samples=60, max_age_ms=30000)
+#   batcher.configure('temperature', mode=AGGREGATE)
+#   while True:
+#       batcher.add('humidity', read_humidity())
+#       batcher.add('temperature', read_temperature())
+#       batcher.service()
+#
+# A SAMPLES batch goes to sensors/<name> as
+#   {"sensor": "humidity", "t0": <unix ms of first sample>, "dt": [0, 1000, 1002, ...], "v": [50.1, ...]}
+# where dt holds the milliseconds since the previous sample. An AGGREGATE batch only
+# carries "n", "min", "max", "mean" and "last" for the window between t0 and t1.
+#
+# Timestamps come from ticks_ms() against a wall clock reading taken once, so they keep
+# millisecond resolution. Call sync_clock() after setting the RTC (e.g. with ntptime).
+
+import json
+import time
+from array import array
+
+SAMPLES = "samples"
+AGGREGATE = "aggregate"
+
+# Seconds from 1970 to the epoch time.time() counts from, which is 2000 on most ports
+EPOCH_OFFSET_S = 946684800 if time.gmtime(0)[0] == 2000 else 0
+REBASE_MS = 86400000  # ticks_diff() only holds within half the ticks period, so move the base on daily
+
+
+class _Series:
+    # Ring of (ticks, value) for one sensor, backed by preallocated arrays
+
+    def __init__(self, mode, max_samples, max_age_ms):
+        self.mode = mode
+        self.max_age_ms = max_age_ms
+        self.capacity = max_samples
+        self.start = 0
+        self.count = 0
+        self.size = 0  # Encoded bytes of the batch so far, topic included
+        if mode == SAMPLES:
+            self.ticks = array("l", [0] * max_samples)
+            self.values = array("f", [0] * max_samples)
+        else:
+            self.first = self.last_ticks = 0
+            self.min = self.max = self.total = self.last = 0.0
+
+    def add(self, ticks, value):
+        if self.mode == AGGREGATE:
+            if not self.count:
+                self.first = ticks
+                self.min = self.max = value
+                self.total = 0.0
+            elif value < self.min:
+                self.min = value
+            elif value > self.max:
+                self.max = value
+            self.total += value
+            self.last = value
+            self.last_ticks = ticks
+            self.count += 1
+            return
+        if self.count == self.capacity:
+            # Only happens when publishing failed; make room by dropping the oldest sample
+            self.start = (self.start + 1) % self.capacity
+            self.count -= 1
+        i = (self.start + self.count) % self.capacity
+        self.ticks[i] = ticks
+        self.values[i] = value
+        self.count += 1
+
+    def pop_last(self):
+        self.count -= 1
+        i = (self.start + self.count) % self.capacity
+        return self.ticks[i], self.values[i]
+
+    def first_ticks(self):
+        return self.first if self.mode == AGGREGATE else self.ticks[self.start]
+
+    def clear(self):
+        self.start = 0
+        self.count = 0
+        self.size = 0
+
+
+class SensorBatcher:
+
+    def __init__(self, handler, max_samples=32, max_age_ms=10000, max_bytes=512, mode=SAMPLES, digits=3, qos=0):
+        self.handler = handler
+        self.max_samples = max_samples  # Flush once a sensor has this many samples
+        self.max_age_ms = max_age_ms  # ... or once its oldest sample is this old
+        self.max_bytes = max_bytes  # ... or before the topic and JSON payload would grow beyond this
+        self.mode = mode
+        self.digits = digits  # Values are rounded to this many decimals when published
+        self.qos = qos
+        self._series = {}
+        self.sync_clock()
+
+    def sync_clock(self):
+        # Take the wall clock reading that timestamps are counted from
+        self._base_ticks = time.ticks_ms()
+        if hasattr(time, "time_ns"):  # Sub-second resolution where the port has it
+            self._base_ms = time.time_ns() // 1000000 + EPOCH_OFFSET_S * 1000
+        else:
+            self._base_ms = (int(time.time()) + EPOCH_OFFSET_S) * 1000
+
+    def _rebase(self, now):
+        since = time.ticks_diff(now, self._base_ticks)
+        if since > REBASE_MS:
+            self._base_ms += since
+            self._base_ticks = now
+
+    def configure(self, sensor_name, mode=None, max_samples=None, max_age_ms=None):
+        # Per-sensor settings; pending samples for the sensor are flushed first
+        if sensor_name in self._series:
+            self.flush(sensor_name)
+        self._series[sensor_name] = _Series(mode or self.mode, max_samples or self.max_samples, max_age_ms or self.max_age_ms)
+
+    def add(self, sensor_name, value, ticks=None):
+        series = self._series.get(sensor_name)
+        if series is None:
+            self.configure(sensor_name)
+            series = self._series[sensor_name]
+        now = time.ticks_ms()
+        self._rebase(now)
+        full = series.count == series.capacity  # Publishing failed, so adding drops the oldest sample
+        series.add(now if ticks is None else ticks, value)
+        if series.mode == SAMPLES:
+            if full:
+                self._recount(sensor_name, series)
+            else:
+                self._count_bytes(sensor_name, series, series.count - 1)
+            if series.size > self.max_bytes and series.count > 1:
+                # The new sample doesn't fit: send the batch without it, and start the next one with it
+                ticks, value = series.pop_last()
+                try:
+                    self.flush(sensor_name)
+                finally:
+                    series.add(ticks, value)
+                    self._recount(sensor_name, series)
+        if series.count >= series.capacity:
+            self.flush(sensor_name)
+
+    def _recount(self, sensor_name, series):
+        for k in range(series.count):
+            self._count_bytes(sensor_name, series, k)
+
+    def _count_bytes(self, sensor_name, series, k):
+        # Adds what sample k takes in the encoded message to series.size; the first one
+        # starts it over with the topic and the rest of the payload
+        i = (series.start + k) % series.capacity
+        value = len(repr(round(series.values[i], self.digits)))
+        if k:
+            delta = time.ticks_diff(series.ticks[i], series.ticks[(i - 1) % series.capacity])
+            series.size += len(str(delta)) + value + 4  # Two ", " separators
+            return
+        envelope = {"sensor": sensor_name, "t0": self._wall_ms(series.ticks[i]), "dt": [], "v": []}
+        series.size = len(self._topic(sensor_name)) + len(json.dumps(envelope)) + 1 + value
+
+    @staticmethod
+    def _topic(sensor_name):
+        return f"sensors/{sensor_name}"
+
+    def service(self):
+        # Flush sensors whose oldest sample is older than their max age; returns the ms
+        # until the next one is due, or None when nothing is buffered
+        now = time.ticks_ms()
+        self._rebase(now)
+        wait = None
+        for sensor_name, series in self._series.items():
+            if not series.count:
+                continue
+            left = series.max_age_ms - time.ticks_diff(now, series.first_ticks())
+            if left <= 0:
+                self.flush(sensor_name)
+                continue
+            wait = left if wait is None else min(wait, left)
+        return wait
+
+    def flush(self, sensor_name=None):
+        if sensor_name is None:
+            for name in self._series:
+                self.flush(name)
+            return
+        series = self._series.get(sensor_name)
+        if series is None or not series.count:
+            return
+        payload = self._payload(sensor_name, series)
+        # Samples stay buffered if publishing raises, so they go out with the next batch
+        self.handler.publish_message(self._topic(sensor_name), payload, qos=self.qos)
+        series.clear()
+
+    def _wall_ms(self, ticks):
+        return self._base_ms + time.ticks_diff(ticks, self._base_ticks)
+
+    def _payload(self, sensor_name, series):
+        digits = self.digits
+        if series.mode == AGGREGATE:
+            return {
+                "sensor": sensor_name,
+                "t0": self._wall_ms(series.first),
+                "t1": self._wall_ms(series.last_ticks),
+                "n": series.count,
+                "min": round(series.min, digits),
+                "max": round(series.max, digits),
+                "mean": round(series.total / series.count, digits),
+                "last": round(series.last, digits),
+            }
+        dt = []
+        values = []
+        prev = series.ticks[series.start]
+        for k in range(series.count):
+            i = (series.start + k) % series.capacity
+            dt.append(time.ticks_diff(series.ticks[i], prev))
+            values.append(round(series.values[i], digits))
+            prev = series.ticks[i]
+        return {"sensor": sensor_name, "t0": self._wall_ms(series.ticks[series.start]), "dt": dt, "v": values}
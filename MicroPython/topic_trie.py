@@ -0,0 +1,102 @@
+# topic_trie.py
+
+# Subscription index following the MQTT 3.1.1 topic matching rules (section 4.7):
+# '+' matches exactly one (possibly empty) level, '#' matches the parent level and
+# everything below it, and wildcards at the first level never match topics starting with '$'.
+
+
+class _Node:
+    __slots__ = ("children", "callbacks")
+
+    def __init__(self):
+        self.children = {}
+        self.callbacks = []
+
+
+class TopicTrie:
+
+    def __init__(self, cache_size=32, key=None):
+        self.root = _Node()
+        self.cache_size = cache_size
+        # match() returns an entry only once, even when several matching filters hold it.
+        # With key, entries count as the same when their keys are equal: MQTTHandler stores
+        # (callback, codec) and keys on the callback, so a callback registered under two
+        # overlapping filters with different codecs still fires once, with the codec of
+        # the first match ('#' filters, then exact levels, then '+').
+        self.key = key
+        self._cache = {}
+
+    def add(self, pattern, callback):
+        node = self.root
+        for level in pattern.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = _Node()
+                node.children[level] = child
+            node = child
+        node.callbacks.append(callback)
+        self._cache.clear()
+
+    def remove(self, pattern, callback=None):
+        path = [self.root]
+        levels = pattern.split('/')
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        node = path[-1]
+        if callback is None:
+            node.callbacks = []
+        elif callback in node.callbacks:
+            node.callbacks.remove(callback)
+        # Prune branches that no longer lead to any callback
+        for i in range(len(levels) - 1, -1, -1):
+            node = path[i + 1]
+            if node.callbacks or node.children:
+                break
+            del path[i].children[levels[i]]
+        self._cache.clear()
+
+    def match(self, topic):
+        callbacks = self._cache.get(topic)
+        if callbacks is not None:
+            return callbacks
+        callbacks = []
+        self._collect(self.root, topic.split('/'), 0, topic.startswith('$'), callbacks)
+        if len(self._cache) >= self.cache_size:
+            del self._cache[next(iter(self._cache))]
+        self._cache[topic] = callbacks
+        return callbacks
+
+    def _collect(self, node, levels, depth, system, out):
+        wildcards = not (system and depth == 0)
+        if wildcards:
+            multi = node.children.get('#')
+            if multi is not None:
+                self._extend(out, multi.callbacks)
+        if depth == len(levels):
+            self._extend(out, node.callbacks)
+            return
+        child = node.children.get(levels[depth])
+        if child is not None:
+            self._collect(child, levels, depth + 1, system, out)
+        if wildcards:
+            child = node.children.get('+')
+            if child is not None:
+                self._collect(child, levels, depth + 1, system, out)
+
+    def _extend(self, out, entries):
+        key = self.key
+        for entry in entries:
+            if key is None:
+                if entry not in out:
+                    out.append(entry)
+                continue
+            k = key(entry)
+            for other in out:
+                if key(other) == k:
+                    break
+            else:
+                out.append(entry)
+
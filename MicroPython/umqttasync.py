@@ -0,0 +1,302 @@
+# umqttasync.py
+
+# asyncio (uasyncio) variant of umqttsimple.MQTTClient. Packets are encoded and framed by the
+# same code as the blocking client; only the socket I/O is replaced by asyncio streams.
+# A background task reads and dispatches incoming packets, another one keeps the connection alive.
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+import time
+
+import umqttsimple
+from umqttsimple import MQTTException
+
+
+class _StreamSocket:
+    # Lets the encoders inherited from umqttsimple write straight into an asyncio stream
+
+    def __init__(self, client, writer):
+        self.client = client
+        self.writer = writer
+
+    def write(self, buf, n=None):
+        if n is not None:
+            buf = buf[:n]
+        self.writer.write(buf)
+        self.client._last_tx = time.ticks_ms()
+
+    def setblocking(self, flag):
+        pass
+
+    def close(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class MQTTClient(umqttsimple.MQTTClient):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connected = False
+        self._reader = None
+        self._read_task = None
+        self._ping_task = None
+        self._last_tx = 0
+        self._ack = asyncio.Event()
+        self._subacks = {}
+        self._closed = asyncio.Event()
+
+    def set_callback(self, f):
+        # Coroutine callbacks run as their own tasks so a slow handler can't stall the reader
+        def run(topic, msg):
+            res = f(topic, msg)
+            if hasattr(res, "send"):
+                asyncio.create_task(res)
+        self.cb = run
+
+    async def connect(self, clean_session=True):
+        if self.ssl:
+            # asyncio streams take the context but have no way to resume a session
+            ctx = self.ssl_context() or True
+            hostname = self.ssl_params.get("server_hostname", self.server)
+            self._reader, writer = await asyncio.open_connection(self.server, self.port, ssl=ctx, server_hostname=hostname)
+        else:
+            self._reader, writer = await asyncio.open_connection(self.server, self.port)
+        self.sock = _StreamSocket(self, writer)
+        self._rpos = self._rend = 0
+        self._send_connect(clean_session)
+        await self._drain()
+        hdr = await self._reader.readexactly(2)
+        assert hdr[0] == 0x20
+        while hdr[-1] & 0x80:
+            hdr += await self._reader.readexactly(1)
+        body = await self._reader.readexactly(self._get_len(hdr, 1)[0])
+        self.connected = True
+        self._closed.clear()
+        session_present = self._connack(body)
+        await self._drain()
+        self._read_task = asyncio.create_task(self._read_loop())
+        if self.keepalive:
+            self._ping_task = asyncio.create_task(self._keepalive_loop())
+        return session_present
+
+    async def disconnect(self):
+        if self.connected:
+            self.sock.write(b"\xe0\0")
+            await self._drain()
+        self._lost()
+
+    def close(self):
+        # Drop the connection without a DISCONNECT, e.g. after a failed write
+        self._lost()
+
+    async def wait_closed(self):
+        await self._closed.wait()
+
+    async def _drain(self):
+        await self.sock.writer.drain()
+
+    def _lost(self):
+        if self.sock is None:
+            return
+        self.connected = False
+        self.sock.close()
+        self.sock = None
+        for task in (self._read_task, self._ping_task):
+            if task is not None:
+                task.cancel()
+        self._read_task = self._ping_task = None
+        # Wake everything waiting on the broker so it can see the connection is gone
+        self._ack.set()
+        for pid in self._subacks:
+            if self._subacks[pid] is None:
+                self._subacks[pid] = -1
+        self._closed.set()
+
+    def _check_connected(self):
+        if not self.connected:
+            raise OSError(-1)
+
+    async def publish(self, topic, msg, retain=False, qos=0):
+        assert qos < 2
+        topic = self._bytes(topic)
+        msg = self._bytes(msg)
+        pid = 0
+        if qos > 0:
+            # Recorded before anything can fail, as in umqttsimple: if the link drops while
+            # we wait for a slot or write, connect() sends it with the other unacked ones
+            pid = self._next_pid()
+            self.inflight[pid] = (topic, msg, retain, time.ticks_ms())
+            while len(self.inflight) > self.max_inflight:
+                await self._wait_ack()
+            if pid not in self.inflight:
+                return pid  # A reconnect while we waited resent it, and it has been acked
+        self._check_connected()
+        self._send_publish(topic, msg, retain, qos, pid)
+        await self._drain()
+        return pid
+
+    async def publish_batch(self, messages, retain=False, qos=0):
+        # umqttsimple's publish_batch, awaiting free in-flight slots and each write
+        assert qos < 2
+        self._check_connected()
+        buf = self._wmv
+        i = 0
+        count = 0
+        for topic, msg in messages:
+            topic = self._bytes(topic)
+            msg = self._bytes(msg)
+            sz = self._publish_size(topic, msg, qos)
+            total = 1 + self._len_size(sz) + sz
+            if i and i + total > len(buf):
+                self.sock.write(buf[:i])
+                await self._drain()
+                i = 0
+            if total > len(buf):
+                await self.publish(topic, msg, retain, qos)
+            else:
+                pid = 0
+                if qos > 0:
+                    pid = self._next_pid()
+                    self.inflight[pid] = (topic, msg, retain, time.ticks_ms())
+                    if len(self.inflight) > self.max_inflight:
+                        if i:
+                            self.sock.write(buf[:i])
+                            await self._drain()
+                            i = 0
+                        await self.wait_inflight(self.max_inflight)
+                i = self._pack_publish_header(buf, i, topic, retain, qos, pid, sz)
+                buf[i:i + len(msg)] = msg
+                i += len(msg)
+            count += 1
+        if i:
+            self.sock.write(buf[:i])
+            await self._drain()
+        return count
+
+    async def wait_inflight(self, limit=0):
+        while len(self.inflight) > limit:
+            await self._wait_ack()
+
+    async def _wait_ack(self):
+        self._check_connected()
+        self._ack.clear()
+        await self._ack.wait()
+        self._check_connected()
+
+    async def subscribe(self, topic, qos=0):
+        assert self.cb is not None, "Subscribe callback is not set"
+        self._check_connected()
+        pid = self._send_subscribe(topic, qos)
+        self._subacks[pid] = None
+        try:
+            await self._drain()
+            while self._subacks[pid] is None:
+                self._ack.clear()
+                await self._ack.wait()
+            self._check_connected()
+            if self._subacks[pid] >= 0x80:
+                raise MQTTException(self._subacks[pid])
+        finally:
+            del self._subacks[pid]
+
+    async def wait_msg(self):
+        while 1:
+            pkt = self._frame()
+            if pkt is not None:
+                op, start, sz = pkt
+                if self.stream_cb is not None and op & 0xf0 == 0x30 and sz > self.stream_threshold:
+                    hdr = self._header_end(op, start)
+                    if hdr is not None:
+                        return await self._stream_async(op, start, sz, hdr)
+                    if self._rpos or self._rend < len(self._rbuf):
+                        pkt = None  # Read on until the variable header is in
+                if pkt is not None and start + sz <= self._rend:
+                    body = self._rmv[start:start + sz]
+                    self._rpos = start + sz
+                    break
+                if pkt is not None and start - self._rpos + sz > len(self._rbuf):
+                    body = await self._read_large_async(start, sz)
+                    break
+            space = self._recv_space()
+            data = await self._reader.read(len(space))
+            if not data:
+                raise OSError(-1)
+            space[:len(data)] = data
+            self._rend += len(data)
+        return self._process(op, body)
+
+    async def _read_large_async(self, start, sz):
+        body = bytearray(sz)
+        mv = memoryview(body)
+        have = self._rend - start
+        mv[:have] = self._rmv[start:self._rend]
+        self._rpos = self._rend = 0
+        mv[have:] = await self._reader.readexactly(sz - have)
+        return mv
+
+    async def _stream_async(self, op, start, sz, hdr):
+        # Like umqttsimple's _stream; the stream callback itself must not be a coroutine
+        topic, pid, _ = self._publish_header(op, self._rmv[start:hdr])
+        topic = bytes(topic)
+        total = sz - (hdr - start)
+        end = min(self._rend, start + sz)
+        offset = end - hdr
+        if offset:
+            self.stream_cb(topic, self._rmv[hdr:end], 0, total)
+        if end < self._rend:
+            self._rpos = end
+        else:
+            self._rpos = self._rend = 0
+        while offset < total:
+            data = await self._reader.read(min(len(self._rbuf), total - offset))
+            if not data:
+                raise OSError(-1)
+            self.stream_cb(topic, data, offset, total)
+            offset += len(data)
+        self._puback(op, pid)
+
+    async def _read_loop(self):
+        try:
+            while 1:
+                op = await self.wait_msg()
+                if op == 0x40:
+                    self._ack.set()
+                elif op == 0x90:
+                    pid = self._body[0] << 8 | self._body[1]
+                    if pid in self._subacks:
+                        self._subacks[pid] = self._suback_code(self._body)
+                        self._ack.set()
+                await self._drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"MQTT connection lost: {e}")
+        self._read_task = None
+        self._lost()
+
+    async def _keepalive_loop(self):
+        # Ping at half the keepalive when idle; an unanswered ping means the link is half-open
+        interval = self.keepalive * 500
+        ping_sent = 0
+        while self.connected:
+            now = time.ticks_ms()
+            if self.ping_outstanding:
+                wait = interval - time.ticks_diff(now, ping_sent)
+                if wait <= 0:
+                    print("No PINGRESP from MQTT broker, connection is half-open")
+                    break
+            else:
+                wait = interval - time.ticks_diff(now, self._last_tx)
+                if wait <= 0:
+                    self.ping()
+                    ping_sent = now
+                    await self._drain()
+                    continue
+            await asyncio.sleep(wait / 1000)
+        self._ping_task = None
+        self._lost()
@@ -7,24 +7,49 @@ try:
 except:
     import socket
 
+import time
+
 import machine
 import ubinascii
 import ustruct as struct
 
 
+# MQTT 5 property identifiers and how their values are encoded: 1, 2 or 4 byte integers,
+# 0 for a variable byte integer, 3 for a string or binary data, 6 for a string pair
+PROPERTY_TYPES = {
+    0x01: 1, 0x02: 4, 0x03: 3, 0x08: 3, 0x09: 3, 0x0b: 0, 0x11: 4, 0x12: 3, 0x13: 2, 0x15: 3,
+    0x16: 3, 0x17: 1, 0x18: 4, 0x19: 1, 0x1a: 3, 0x1c: 3, 0x1f: 3, 0x21: 2, 0x22: 2, 0x23: 2,
+    0x24: 1, 0x25: 1, 0x26: 6, 0x27: 4, 0x28: 1, 0x29: 1, 0x2a: 1,
+}
+SESSION_EXPIRY = 0x11
+ASSIGNED_CLIENT_ID = 0x12
+SERVER_KEEP_ALIVE = 0x13
+RECEIVE_MAXIMUM = 0x21
+TOPIC_ALIAS_MAXIMUM = 0x22
+TOPIC_ALIAS = 0x23
+
+# Keys ssl_params may have: those of ussl.wrap_socket, plus cafile (a CA file instead of cadata)
+SSL_PARAMS = ("key", "cert", "cadata", "cafile", "cert_reqs", "server_hostname", "do_handshake", "server_side")
+
+
 class MQTTException(Exception):
     pass
 
 
 class MQTTClient:
 
-    def __init__(self, client_id=None, server=None, broker_port=None, user=None, password=None, keepalive=None, ssl=None, ssl_params=None):
+    def __init__(self, client_id=None, server=None, broker_port=None, user=None, password=None, keepalive=None, ssl=None, ssl_params=None, buffer_size=None, recv_buffer_size=None, zero_copy=False, max_inflight=None, protocol=4, topic_aliases=16, receive_maximum=None):
         self.client_id = client_id or ubinascii.hexlify(machine.unique_id())
         self.server = server or '192.192.192.192'  # Default server IP
         self.ssl = ssl or False
         self.port = broker_port or (8883 if self.ssl else 1883)
         self.keepalive = keepalive or 0
         self.ssl_params = ssl_params or {}
+        self._check_ssl_params()
+        # The TLS context, with its certificates parsed, is built on the first connect and
+        # used for every reconnect after it. ssl can also be an SSLContext made elsewhere.
+        self._ssl_context = ssl if hasattr(ssl, "wrap_socket") else None
+        self.ssl_session = None  # Offered on reconnect to skip the full handshake, where the port supports it
         self.sock = None
         self.pid = 0
         self.cb = None
@@ -34,24 +59,198 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        self.ping_outstanding = 0
+        # Outgoing packets are serialized into this buffer and sent with a single write
+        self._wbuf = bytearray(buffer_size or 256)
+        self._wmv = memoryview(self._wbuf)
+        # Incoming bytes are read in bulk into this buffer and framed into packets from there
+        self._rbuf = bytearray(recv_buffer_size or 512)
+        self._rmv = memoryview(self._rbuf)
+        self._rpos = 0
+        self._rend = 0
+        self._body = None
+        # Hand topic and payload to the callback as memoryviews into the receive buffer.
+        # They are only valid until the callback returns or calls back into the client.
+        self.zero_copy = zero_copy
+        self._max_inflight = max_inflight or 1
+        self.max_inflight = self._max_inflight  # Lowered to the broker's Receive Maximum with MQTT 5
+        self.inflight = {}  # pid -> (topic, msg, retain, ticks_ms when first sent)
+        self.on_puback = None  # Called with (pid, latency_ms) when a QoS 1 message is acknowledged
+        self._deferred = []
+        self._deferring = 0
+        # protocol=5 speaks MQTT 5. Topics we publish more than once are then replaced by a
+        # 2 byte topic alias after the first time, as far as the broker allows, and the broker
+        # may do the same for up to topic_aliases topics it sends us. receive_maximum limits
+        # how many unacknowledged QoS 1 messages the broker sends us at once.
+        self.protocol = protocol
+        self.topic_aliases = topic_aliases
+        self.receive_maximum = receive_maximum
+        self._aliases = {}  # topic -> alias, for topics we publish
+        self._alias_max = 0  # Aliases the broker accepts from us, from its CONNACK
+        self._in_aliases = {}  # alias -> topic, for topics the broker sends us
+        self.stream_cb = None
+        self.stream_threshold = 0
+
+    @staticmethod
+    def _len_size(sz):
+        if sz < 0x80:
+            return 1
+        if sz < 0x4000:
+            return 2
+        if sz < 0x200000:
+            return 3
+        return 4
 
-    def _send_str(self, s):
-        self.sock.write(struct.pack("!H", len(s)))
-        self.sock.write(s)
+    @staticmethod
+    def _put_len(buf, i, sz):
+        while sz > 0x7f:
+            buf[i] = (sz & 0x7f) | 0x80
+            sz >>= 7
+            i += 1
+        buf[i] = sz
+        return i + 1
 
-    def _recv_len(self):
+    @staticmethod
+    def _get_len(buf, i):
+        # Variable byte integer at buf[i]; returns (value, index after it)
         n = 0
         sh = 0
         while 1:
-            b = self.sock.read(1)[0]
+            b = buf[i]
+            i += 1
             n |= (b & 0x7f) << sh
             if not b & 0x80:
-                return n
+                return n, i
             sh += 7
 
+    def _read_props(self, buf, i):
+        # MQTT 5 properties at buf[i]; returns ({id: value}, index after them)
+        n, i = self._get_len(buf, i)
+        end = i + n
+        props = {}
+        while i < end:
+            prop = buf[i]
+            kind = PROPERTY_TYPES[prop]
+            i += 1
+            if kind == 1:
+                value = buf[i]
+                i += 1
+            elif kind == 2:
+                value = buf[i] << 8 | buf[i + 1]
+                i += 2
+            elif kind == 4:
+                value = struct.unpack_from("!I", buf, i)[0]
+                i += 4
+            elif kind == 0:
+                value, i = self._get_len(buf, i)
+            else:
+                n = buf[i] << 8 | buf[i + 1]
+                value = bytes(buf[i + 2:i + 2 + n])
+                i += 2 + n
+                if kind == 6:
+                    n = buf[i] << 8 | buf[i + 1]
+                    value = (value, bytes(buf[i + 2:i + 2 + n]))
+                    i += 2 + n
+            props[prop] = value
+        return props, end
+
+    def _connect_props(self, clean_session):
+        props = bytearray()
+        if self.topic_aliases:
+            props += struct.pack("!BH", TOPIC_ALIAS_MAXIMUM, self.topic_aliases)
+        if self.receive_maximum:
+            props += struct.pack("!BH", RECEIVE_MAXIMUM, self.receive_maximum)
+        if not clean_session:
+            # An MQTT 5 session ends with the connection unless it is given an expiry
+            props += struct.pack("!BI", SESSION_EXPIRY, 0xffffffff)
+        return props
+
+    @staticmethod
+    def _put_str(buf, i, s):
+        n = len(s)
+        buf[i] = n >> 8
+        buf[i + 1] = n & 0xff
+        buf[i + 2:i + 2 + n] = s
+        return i + 2 + n
+
+    @staticmethod
+    def _bytes(s):
+        return s.encode() if isinstance(s, str) else s
+
+    def _packet_buf(self, n):
+        # Packets that don't fit the preallocated buffer get a one-off buffer of their own
+        if n <= len(self._wbuf):
+            return self._wmv
+        return memoryview(bytearray(n))
+
+    def _next_pid(self):
+        self.pid = self.pid % 65535 + 1
+        return self.pid
+
+    def _recv_space(self):
+        if self._rpos == self._rend:
+            self._rpos = self._rend = 0
+        elif self._rend == len(self._rbuf):
+            # Move the partial packet to the front to make room for the rest of it
+            n = self._rend - self._rpos
+            self._rmv[:n] = self._rmv[self._rpos:self._rend]
+            self._rpos = 0
+            self._rend = n
+        return self._rmv[self._rend:]
+
+    def _fill(self):
+        n = self.sock.readinto(self._recv_space())
+        if n is None:
+            return None
+        if n == 0:
+            raise OSError(-1)
+        self._rend += n
+        return n
+
+    # Returns (op, body_start, body_size) of the packet at the head of the
+    # receive buffer, or None while its fixed header is still incomplete.
+    def _frame(self):
+        buf = self._rbuf
+        i = self._rpos + 1
+        sz = 0
+        sh = 0
+        while 1:
+            if i >= self._rend:
+                return None
+            b = buf[i]
+            i += 1
+            sz |= (b & 0x7f) << sh
+            if not b & 0x80:
+                return buf[self._rpos], i, sz
+            sh += 7
+
+    def _read_large(self, start, sz):
+        # Packets bigger than the receive buffer are completed in a buffer of their own
+        body = bytearray(sz)
+        mv = memoryview(body)
+        have = self._rend - start
+        mv[:have] = self._rmv[start:self._rend]
+        self._rpos = self._rend = 0
+        self.sock.setblocking(True)
+        while have < sz:
+            n = self.sock.readinto(mv[have:])
+            if not n:
+                raise OSError(-1)
+            have += n
+        return mv
+
     def set_callback(self, f):
         self.cb = f
 
+    # Messages with a payload over threshold bytes are passed to f(topic, chunk, offset, total)
+    # a piece at a time instead of to the callback, so they never have to fit in memory.
+    # chunk is a memoryview into the receive buffer, only valid until f returns, and f must
+    # not read from the client. These messages can't be held back, so they are also delivered
+    # while publish() or subscribe() wait for the broker.
+    def set_stream_callback(self, f, threshold=None):
+        self.stream_cb = f
+        self.stream_threshold = threshold or len(self._rbuf)
+
     def set_last_will(self, topic, msg, retain=False, qos=0):
         assert 0 <= qos <= 2
         assert topic
@@ -65,47 +264,145 @@ class MQTTClient:
         addr = socket.getaddrinfo(self.server, self.port)[0][-1]
         self.sock.connect(addr)
         if self.ssl:
+            self.sock = self._wrap_ssl(self.sock)
+        self._send_connect(clean_session)
+        self._rpos = self._rend = 0
+        hdr = self.sock.read(2)
+        assert hdr[0] == 0x20
+        while hdr[-1] & 0x80:  # MQTT 5 CONNACK properties can take it past 127 bytes
+            hdr += self.sock.read(1)
+        session_present = self._connack(self.sock.read(self._get_len(hdr, 1)[0]))
+        if not session_present:
+            # The packet ids of deferred QoS 1 deliveries went with the old session, so
+            # they are still delivered but no longer acknowledged
+            self._deferred = [(op & ~6, 0, topic, msg) for op, pid, topic, msg in self._deferred]
+        if self.ssl:
+            # With TLS 1.3 the session ticket follows the handshake, so it is in by now
+            self.ssl_session = getattr(self.sock, "session", None) or self.ssl_session
+        return session_present
+
+    def ssl_context(self):
+        # Our SSLContext, built from ssl_params the first time; None on ports without one.
+        # ssl_params takes the keyword arguments of ussl.wrap_socket, plus cafile.
+        if self._ssl_context is None:
+            p = self.ssl_params
+            try:
+                import ssl
+            except ImportError:
+                import ussl as ssl
+            if not hasattr(ssl, "SSLContext"):
+                return None
+            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            # Given a CA, the broker's certificate is checked against it unless cert_reqs says otherwise
+            ca = p.get("cadata") or p.get("cafile")
+            verify = p.get("cert_reqs", ssl.CERT_REQUIRED if ca else ssl.CERT_NONE)
+            if "cert_reqs" not in p and not ca:
+                print("TLS without cadata or cafile: the broker's certificate is not verified")
+            if verify != ssl.CERT_REQUIRED and hasattr(ctx, "check_hostname"):
+                ctx.check_hostname = False  # CPython won't drop verification otherwise
+            ctx.verify_mode = verify
+            if ca:
+                ctx.load_verify_locations(cafile=p.get("cafile"), cadata=p.get("cadata"))
+            if p.get("cert") or p.get("key"):
+                ctx.load_cert_chain(p.get("cert"), p.get("key"))
+            self._ssl_context = ctx
+        return self._ssl_context
+
+    def _check_ssl_params(self):
+        p = self.ssl_params
+        for key in p:
+            if key not in SSL_PARAMS:
+                raise ValueError("Unknown ssl_params key: %s" % key)
+        if p.get("server_side"):
+            raise ValueError("An MQTT client can't be the TLS server")
+
+    def _wrap_ssl(self, sock):
+        ctx = self.ssl_context()
+        if ctx is None:
+            # Ports without SSLContext: the old ussl.wrap_socket, with the same defaults as above
             import ussl
-            self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
-        premsg = bytearray(b"\x10\0\0\0\0\0")
-        msg = bytearray(b"\x04MQTT\x04\x02\0\0")
+            params = dict(self.ssl_params)
+            if "cafile" in params:
+                with open(params.pop("cafile"), "rb") as f:
+                    params["cadata"] = f.read()
+            if params.get("cadata"):
+                params.setdefault("cert_reqs", ussl.CERT_REQUIRED)
+            return ussl.wrap_socket(sock, **params)
+        hostname = self.ssl_params.get("server_hostname", self.server)
+        handshake = self.ssl_params.get("do_handshake", True)
+        if self.ssl_session is not None:
+            return ctx.wrap_socket(sock, server_hostname=hostname, do_handshake_on_connect=handshake, session=self.ssl_session)
+        return ctx.wrap_socket(sock, server_hostname=hostname, do_handshake_on_connect=handshake)
 
-        sz = 10 + 2 + len(self.client_id)
-        msg[6] = clean_session << 1
+    def _send_connect(self, clean_session):
+        client_id = self._bytes(self.client_id)
+        sz = 10 + 2 + len(client_id)
+        if self.protocol == 5:
+            props = self._connect_props(clean_session)
+            sz += self._len_size(len(props)) + len(props)
+        flags = clean_session << 1
         if self.user is not None:
-            sz += 2 + len(self.user) + 2 + len(self.pswd)
-            msg[6] |= 0xC0
+            user = self._bytes(self.user)
+            pswd = self._bytes(self.pswd)
+            sz += 2 + len(user) + 2 + len(pswd)
+            flags |= 0xC0
         if self.keepalive:
             assert self.keepalive < 65536
-            msg[7] |= self.keepalive >> 8
-            msg[8] |= self.keepalive & 0x00FF
         if self.lw_topic:
-            sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
-            msg[6] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
-            msg[6] |= self.lw_retain << 5
+            lw_topic = self._bytes(self.lw_topic)
+            lw_msg = self._bytes(self.lw_msg)
+            sz += 2 + len(lw_topic) + 2 + len(lw_msg)
+            if self.protocol == 5:
+                sz += 1  # No will properties
+            flags |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
+            flags |= self.lw_retain << 5
 
-        i = 1
-        while sz > 0x7f:
-            premsg[i] = (sz & 0x7f) | 0x80
-            sz >>= 7
-            i += 1
-        premsg[i] = sz
-
-        self.sock.write(premsg, i + 2)
-        self.sock.write(msg)
-        # print(hex(len(msg)), hexlify(msg, ":"))
-        self._send_str(self.client_id)
+        buf = self._packet_buf(1 + self._len_size(sz) + sz)
+        buf[0] = 0x10
+        i = self._put_len(buf, 1, sz)
+        i = self._put_str(buf, i, b"MQTT")
+        buf[i] = self.protocol
+        buf[i + 1] = flags
+        buf[i + 2] = self.keepalive >> 8
+        buf[i + 3] = self.keepalive & 0x00FF
+        i += 4
+        if self.protocol == 5:
+            i = self._put_len(buf, i, len(props))
+            buf[i:i + len(props)] = props
+            i += len(props)
+        i = self._put_str(buf, i, client_id)
         if self.lw_topic:
-            self._send_str(self.lw_topic)
-            self._send_str(self.lw_msg)
+            if self.protocol == 5:
+                buf[i] = 0
+                i += 1
+            i = self._put_str(buf, i, lw_topic)
+            i = self._put_str(buf, i, lw_msg)
         if self.user is not None:
-            self._send_str(self.user)
-            self._send_str(self.pswd)
-        resp = self.sock.read(4)
-        assert resp[0] == 0x20 and resp[1] == 0x02
-        if resp[3] != 0:
-            raise MQTTException(resp[3])
-        return resp[2] & 1
+            i = self._put_str(buf, i, user)
+            i = self._put_str(buf, i, pswd)
+        self.sock.write(buf[:i])
+
+    def _connack(self, body):
+        # body is the CONNACK after its fixed header: flags, return code and, with MQTT 5, properties
+        if body[1] != 0:
+            raise MQTTException(body[1])
+        self.ping_outstanding = 0
+        # Topic aliases only live as long as the connection
+        self._aliases = {}
+        self._in_aliases = {}
+        self._alias_max = 0
+        self.max_inflight = self._max_inflight
+        if self.protocol == 5:
+            props = self._read_props(body, 2)[0]
+            self._alias_max = props.get(TOPIC_ALIAS_MAXIMUM, 0)
+            self.max_inflight = min(self._max_inflight, props.get(RECEIVE_MAXIMUM, 65535))
+            self.keepalive = props.get(SERVER_KEEP_ALIVE, self.keepalive)
+            self.client_id = props.get(ASSIGNED_CLIENT_ID, self.client_id)
+        # Resend unacknowledged QoS 1 messages, oldest first
+        for pid in sorted(self.inflight, key=lambda p: (p - self.pid - 1) % 65535):
+            topic, msg, retain, _ = self.inflight[pid]
+            self._send_publish(topic, msg, retain, 1, pid, dup=True)
+        return body[0] & 1
 
     def disconnect(self):
         self.sock.write(b"\xe0\0")
@@ -113,90 +410,316 @@ class MQTTClient:
 
     def ping(self):
         self.sock.write(b"\xc0\0")
+        self.ping_outstanding += 1
 
-    def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
+    def _alias(self, topic):
+        # (alias, known) for an MQTT 5 publish to topic; a new alias is handed out while
+        # the broker takes more, and once it is known the topic itself is left out
+        alias = self._aliases.get(topic)
+        if alias is not None:
+            return alias, True
+        if len(self._aliases) < self._alias_max:
+            return len(self._aliases) + 1, False
+        return 0, False
+
+    def _publish_size(self, topic, msg, qos):
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
+        if self.protocol == 5:
+            alias, known = self._alias(topic)
+            sz += 1
+            if alias:
+                sz += 3
+            if known:
+                sz -= len(topic)
+        return sz
+
+    def _pack_publish_header(self, buf, i, topic, retain, qos, pid, sz, dup=False):
+        # sz must come from _publish_size, which picks the same alias as this
+        buf[i] = 0x30 | dup << 3 | qos << 1 | retain
+        i = self._put_len(buf, i + 1, sz)
+        alias = 0
+        if self.protocol == 5:
+            alias, known = self._alias(topic)
+            if known:
+                topic = b""
+            elif alias:
+                self._aliases[topic] = alias
+        i = self._put_str(buf, i, topic)
+        if qos > 0:
+            buf[i] = pid >> 8
+            buf[i + 1] = pid & 0xff
+            i += 2
+        if self.protocol == 5:
+            if alias:
+                buf[i] = 3
+                buf[i + 1] = TOPIC_ALIAS
+                buf[i + 2] = alias >> 8
+                buf[i + 3] = alias & 0xff
+                i += 4
+            else:
+                buf[i] = 0
+                i += 1
+        return i
+
+    def _send_publish(self, topic, msg, retain, qos, pid, dup=False):
+        sz = self._publish_size(topic, msg, qos)
         assert sz < 2097152
-        i = 1
-        while sz > 0x7f:
-            pkt[i] = (sz & 0x7f) | 0x80
-            sz >>= 7
-            i += 1
-        pkt[i] = sz
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
+        header = 1 + self._len_size(sz) + sz - len(msg)
+        if header + len(msg) <= len(self._wbuf):
+            i = self._pack_publish_header(self._wmv, 0, topic, retain, qos, pid, sz, dup)
+            self._wmv[i:i + len(msg)] = msg
+            self.sock.write(self._wmv[:i + len(msg)])
+        else:
+            # Large payloads are sent from the caller's buffer rather than copied
+            buf = self._packet_buf(header)
+            i = self._pack_publish_header(buf, 0, topic, retain, qos, pid, sz, dup)
+            self.sock.write(buf[:i])
+            self.sock.write(msg)
+
+    # QoS 1 messages stay in self.inflight until their PUBACK arrives, and are
+    # resent with the DUP flag after a reconnect. publish only blocks once
+    # max_inflight messages are unacknowledged.
+    def publish(self, topic, msg, retain=False, qos=0):
+        assert qos < 2
+        topic = self._bytes(topic)
+        msg = self._bytes(msg)
+        pid = 0
         if qos > 0:
-            self.pid += 1
-            pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
+            pid = self._next_pid()
+            self.inflight[pid] = (topic, msg, retain, time.ticks_ms())
+        self._send_publish(topic, msg, retain, qos, pid)
         if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
-        elif qos == 2:
-            assert 0
+            self.wait_inflight(self.max_inflight - 1)
+
+    # Whether this payload object is recorded for a PUBACK, so that a
+    # reconnect resends it.
+    def in_flight(self, msg):
+        for entry in self.inflight.values():
+            if entry[1] is msg:
+                return True
+        return False
+
+    # Pack as many PUBLISH packets as fit into the write buffer before each
+    # socket write. messages is an iterable of (topic, msg) pairs.
+    def publish_batch(self, messages, retain=False, qos=0):
+        assert qos < 2
+        buf = self._wmv
+        i = 0
+        count = 0
+        for topic, msg in messages:
+            topic = self._bytes(topic)
+            msg = self._bytes(msg)
+            sz = self._publish_size(topic, msg, qos)
+            total = 1 + self._len_size(sz) + sz
+            if i and (i + total > len(buf) or qos and len(self.inflight) >= self.max_inflight):
+                self.sock.write(buf[:i])
+                i = 0
+            if total > len(buf):
+                self.publish(topic, msg, retain, qos)
+            else:
+                pid = 0
+                if qos > 0:
+                    self.wait_inflight(self.max_inflight - 1)
+                    pid = self._next_pid()
+                    self.inflight[pid] = (topic, msg, retain, time.ticks_ms())
+                i = self._pack_publish_header(buf, i, topic, retain, qos, pid, sz)
+                buf[i:i + len(msg)] = msg
+                i += len(msg)
+            count += 1
+        if i:
+            self.sock.write(buf[:i])
+        return count
+
+    # Process incoming packets until at most `limit` QoS 1 messages are
+    # unacknowledged. PUBLISH packets arriving meanwhile are held back and
+    # delivered by the next wait_msg/check_msg call.
+    def wait_inflight(self, limit=0):
+        self._deferring += 1
+        try:
+            while len(self.inflight) > limit:
+                self.sock.setblocking(True)
+                self.wait_msg()
+        finally:
+            self._deferring -= 1
 
     def subscribe(self, topic, qos=0):
         assert self.cb is not None, "Subscribe callback is not set"
-        pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt)
-        self._send_str(topic)
-        self.sock.write(qos.to_bytes(1, "little"))
-        while 1:
-            op = self.wait_msg()
-            if op == 0x90:
-                resp = self.sock.read(4)
-                # print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
-                return
+        pid = self._send_subscribe(topic, qos)
+        self._deferring += 1
+        try:
+            while 1:
+                op = self.wait_msg()
+                if op == 0x90:
+                    assert self._body[0] << 8 | self._body[1] == pid
+                    code = self._suback_code(self._body)
+                    if code >= 0x80:
+                        raise MQTTException(code)
+                    return
+        finally:
+            self._deferring -= 1
+
+    def _send_subscribe(self, topic, qos):
+        topic = self._bytes(topic)
+        pid = self._next_pid()
+        sz = 2 + 2 + len(topic) + 1
+        if self.protocol == 5:
+            sz += 1
+        buf = self._packet_buf(1 + self._len_size(sz) + sz)
+        buf[0] = 0x82
+        i = self._put_len(buf, 1, sz)
+        buf[i] = pid >> 8
+        buf[i + 1] = pid & 0xff
+        i += 2
+        if self.protocol == 5:
+            buf[i] = 0  # No properties
+            i += 1
+        i = self._put_str(buf, i, topic)
+        buf[i] = qos
+        self.sock.write(buf[:i + 1])
+        return pid
+
+    def _suback_code(self, body):
+        # Granted QoS, or a failure code from 0x80 up
+        i = 2
+        if self.protocol == 5:
+            n, i = self._get_len(body, i)
+            i += n
+        return body[i]
 
     # Wait for a single incoming MQTT message and process it.
     # Subscribed messages are delivered to a callback previously
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
     def wait_msg(self):
-        res = self.sock.read(1)
-        self.sock.setblocking(True)
-        if res is None:
-            return None
-        if res == b"":
-            raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
-            assert sz == 0
+        if self._deferred and not self._deferring:
+            self.sock.setblocking(True)
+            return self._deliver(*self._deferred.pop(0))
+        while 1:
+            pkt = self._frame()
+            if pkt is not None:
+                op, start, sz = pkt
+                if self.stream_cb is not None and op & 0xf0 == 0x30 and sz > self.stream_threshold:
+                    hdr = self._header_end(op, start)
+                    if hdr is not None:
+                        return self._stream(op, start, sz, hdr)
+                    if self._rpos or self._rend < len(self._rbuf):
+                        pkt = None  # Read on until the variable header is in
+                if pkt is not None and start + sz <= self._rend:
+                    body = self._rmv[start:start + sz]
+                    self._rpos = start + sz
+                    break
+                if pkt is not None and start - self._rpos + sz > len(self._rbuf):
+                    body = self._read_large(start, sz)
+                    break
+            n = self._fill()
+            self.sock.setblocking(True)
+            if n is None:
+                return None
+        return self._process(op, body)
+
+    def _process(self, op, body):
+        if op == 0xd0:  # PINGRESP
+            self.ping_outstanding = 0
             return None
-        op = res[0]
         if op & 0xf0 != 0x30:
+            if op == 0xe0:  # MQTT 5 brokers say why they close the connection
+                raise OSError("Disconnected by MQTT broker, reason %d" % (body[0] if len(body) else 0))
+            if op == 0x40:
+                pid = body[0] << 8 | body[1]
+                entry = self.inflight.pop(pid, None)
+                if entry is not None and self.on_puback is not None:
+                    self.on_puback(pid, time.ticks_diff(time.ticks_ms(), entry[3]))
+            self._body = body
             return op
-        sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
+        topic, pid, i = self._publish_header(op, body)
+        msg = body[i:]
+        if self._deferring:
+            self._deferred.append((op, pid, bytes(topic), bytes(msg)))
+            return None
+        if not self.zero_copy:
+            topic = bytes(topic)
+            msg = bytes(msg)
+        return self._deliver(op, pid, topic, msg)
+
+    def _publish_header(self, op, body):
+        # (topic, pid, payload start) of a PUBLISH body
+        topic_len = body[0] << 8 | body[1]
+        topic = body[2:2 + topic_len]
+        i = 2 + topic_len
+        pid = 0
         if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
+            pid = body[i] << 8 | body[i + 1]
+            i += 2
+        if self.protocol == 5:
+            if body[i]:
+                props, i = self._read_props(body, i)
+                alias = props.get(TOPIC_ALIAS)
+                if alias:
+                    if topic_len:
+                        self._in_aliases[alias] = bytes(topic)
+                    else:
+                        topic = self._in_aliases[alias]
+            else:
+                i += 1
+        return topic, pid, i
+
+    def _header_end(self, op, start):
+        # Where the payload of the PUBLISH whose body starts at start begins, or None
+        # while its variable header isn't all in the receive buffer yet
+        buf = self._rbuf
+        end = self._rend
+        i = start + 2
+        if i > end:
+            return None
+        i += buf[start] << 8 | buf[start + 1]
+        if op & 6:
+            i += 2
+        if self.protocol == 5:
+            if i >= end:
+                return None
+            n = 0
+            sh = 0
+            while 1:
+                b = buf[i]
+                i += 1
+                n |= (b & 0x7f) << sh
+                if not b & 0x80:
+                    break
+                if i >= end:
+                    return None
+                sh += 7
+            i += n
+        return i if i <= end else None
+
+    def _stream(self, op, start, sz, hdr):
+        # Hand the payload to stream_cb as it comes in, reusing the receive buffer for each chunk
+        topic, pid, _ = self._publish_header(op, self._rmv[start:hdr])
+        topic = bytes(topic)
+        total = sz - (hdr - start)
+        end = min(self._rend, start + sz)
+        offset = end - hdr
+        if offset:
+            self.stream_cb(topic, self._rmv[hdr:end], 0, total)
+        if end < self._rend:
+            self._rpos = end  # The packets after this one are already buffered
+        else:
+            self._rpos = self._rend = 0
+        self.sock.setblocking(True)
+        while offset < total:
+            n = self.sock.readinto(self._rmv[:min(len(self._rbuf), total - offset)])
+            if not n:
+                raise OSError(-1)
+            self.stream_cb(topic, self._rmv[:n], offset, total)
+            offset += n
+        self._puback(op, pid)
+
+    def _deliver(self, op, pid, topic, msg):
         self.cb(topic, msg)
+        self._puback(op, pid)
+
+    def _puback(self, op, pid):
         if op & 6 == 2:
             pkt = bytearray(b"\x40\x02\0\0")
             struct.pack_into("!H", pkt, 2, pid)
@@ -210,3 +733,20 @@ class MQTTClient:
     def check_msg(self):
         self.sock.setblocking(False)
         return self.wait_msg()
+
+    # Reads what the socket has into the receive buffer without handling it,
+    # so a connection the broker has closed raises OSError here. The packets
+    # are handled by the next wait_msg/check_msg call.
+    def read_ahead(self):
+        if not len(self._recv_space()):
+            return  # Full of unhandled packets already; reading nothing would look like EOF
+        self.sock.setblocking(False)
+        try:
+            self._fill()
+        finally:
+            self.sock.setblocking(True)
+
+    # True when packets are waiting in the receive buffer or the deferred queue.
+    # Polling the socket won't report these, since they have already been read.
+    def buffered(self):
+        return self._rpos < self._rend or bool(self._deferred and not self._deferring)
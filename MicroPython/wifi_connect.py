@@ -5,15 +5,17 @@ import time
 import machine
 import network
 
+from led import LED
+
 
 class WiFiConnect:
     MAX_WAIT = 30
     SUCCESS_STATUS = 3
 
-    def __init__(self, ssid=None, password=None):
+    def __init__(self, ssid=None, password=None, led=None):
         self.ssid = ssid or 'SSID_OF_YOUR_DESIRED_WIFI'
         self.password = password or 'YOUR_WIFI_SHOULD_PROBABLY_HAVE_A_PASSWORD'
-        self.led = machine.Pin("LED", machine.Pin.OUT)
+        self.led = led or LED()
         self.wlan = network.WLAN(network.STA_IF)
 
     def connect_to_wifi(self):
@@ -24,16 +26,14 @@ class WiFiConnect:
         self.wlan.active(True)
         self.wlan.connect(self.ssid, self.password)
 
-        # Wait for connect or fail
+        # Wait for connect or fail, the LED blinks from its timer meanwhile
+        self.led.play("connecting")
         while self.MAX_WAIT > 0:
             if self.wlan.status() < 0 or self.wlan.status() >= self.SUCCESS_STATUS:
                 break
             self.MAX_WAIT -= 2
             print('waiting for connection…')
-            self.led.on()
-            time.sleep(1)
-            self.led.off()
-            time.sleep(1)
+            time.sleep(2)
 
         # Handle connection errors
         if self.wlan.status() != self.SUCCESS_STATUS:
@@ -42,11 +42,7 @@ class WiFiConnect:
         else:
             status = self.wlan.ifconfig()
             print('Connected! IP address is ' + status[0])
-            for _ in range(6):
-                self.led.on()
-                time.sleep(0.2)
-                self.led.off()
-                time.sleep(0.1)
+            self.led.play("connected")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import threading
+
+import paho.mqtt.client as mqtt
+
+from mqttclient import MQTTClient
+
+log = logging.getLogger(__name__)
+
+
+class AsyncMQTTClient(MQTTClient):
+    """MQTTClient driven by an asyncio event loop instead of paho's network thread.
+
+    paho's socket is handed to the loop through its external loop hooks (loop_read,
+    loop_write, loop_misc), so callbacks, message streams and publish acknowledgements
+    all run on the loop's thread.
+
+        client = AsyncMQTTClient("localhost")
+        await client.connect()
+        await client.publish("sensors/temperature", "21.5", qos=1)  # returns on PUBACK
+        async with client.messages("sensors/#") as stream:
+            async for topic, payload in stream:
+                ...
+    """
+
+    RECONNECT_DELAY = 1  # Seconds, doubled after each failed attempt up to RECONNECT_DELAY_MAX
+    RECONNECT_DELAY_MAX = 60
+    MISC_INTERVAL = 1  # Seconds between loop_misc() calls, which handle keepalive
+
+    def __init__(self, broker="localhost", port=1883, topic=None, metrics_interval=None, metrics_topic=None,
+                 cache_size=1024, cache_path=None, snapshot_interval=30, max_inflight=20, max_queued=0):
+        # No dispatcher workers: everything runs on the event loop
+        super().__init__(broker, port, topic, metrics_interval=metrics_interval, metrics_topic=metrics_topic,
+                         cache_size=cache_size, cache_path=cache_path, snapshot_interval=snapshot_interval,
+                         max_inflight=max_inflight, max_queued=max_queued)
+
+    def _start(self, broker, port):
+        # Nothing happens until connect() is awaited on the loop that will drive the client
+        self._broker = broker
+        self._port = port
+        self._loop = None
+        self._loop_thread = None
+        self._tasks = []
+        self._connected = asyncio.Event()
+        self._disconnected = asyncio.Event()
+        self._connect_lock = asyncio.Lock()
+        self._connect_rc = None
+        self._closing = False
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    async def connect(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._closing = False
+        self._connect_rc = None
+        self._connected.clear()
+        await self._run_connect(self.client.connect, self._broker, self._port, 60)
+        if not self._tasks:  # A retried connect() keeps the tasks the first attempt started
+            self._tasks.append(asyncio.create_task(self._misc_loop()))
+            if self.metrics_interval:
+                self._tasks.append(asyncio.create_task(self._metrics_loop()))
+        await self._connected.wait()
+        if self._connect_rc:
+            raise ConnectionError(f"MQTT Connect failed: {self._connect_rc}")
+
+    async def _run_connect(self, connect, *args):
+        # The TCP connect blocks, so it runs in an executor thread instead of stalling the
+        # loop. The lock keeps _misc_loop from reconnecting while connect() is at it.
+        async with self._connect_lock:
+            sock = self.client.socket()
+            if sock is not None:  # paho closes it from the executor, so stop watching it first
+                self._loop.remove_reader(sock)
+                self._loop.remove_writer(sock)
+            await self._loop.run_in_executor(None, connect, *args)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        super()._on_connect(client, userdata, flags, rc)
+        self._connect_rc = rc
+        self._disconnected.clear()
+        self._connected.set()
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._connected.clear()
+        self._disconnected.set()
+        super()._on_disconnect(client, userdata, 0 if self._closing else rc)
+
+    def _on_loop(self, fn, sock, *args):
+        # paho calls the socket hooks from connect() and reconnect(), which run in an
+        # executor thread, but readers and writers must be registered on the loop's thread.
+        # Deferred calls get the fd, as the socket may be closed by the time they run.
+        if threading.get_ident() == self._loop_thread:
+            fn(sock, *args)
+        else:
+            self._loop.call_soon_threadsafe(fn, sock.fileno(), *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._on_loop(self._loop.add_reader, sock, client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._on_loop(self._loop.remove_reader, sock)
+        self._on_loop(self._loop.remove_writer, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._on_loop(self._loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._on_loop(self._loop.remove_writer, sock)
+
+    async def _misc_loop(self):
+        # Keepalive pings and timeouts, and reconnecting with backoff when the link drops
+        delay = self.RECONNECT_DELAY
+        while not self._closing:
+            if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN and not self._closing and not self._connect_lock.locked():
+                try:
+                    await self._run_connect(self.client.reconnect)
+                    delay = self.RECONNECT_DELAY
+                except OSError as e:
+                    log.warning("reconnect failed error=%s retry_in=%ss", e, delay)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.RECONNECT_DELAY_MAX)
+                    continue
+            await asyncio.sleep(self.MISC_INTERVAL)
+
+    async def _metrics_loop(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            if self.client.is_connected():
+                try:
+                    await self.publish_metrics()
+                except ConnectionError as e:
+                    log.warning("publishing metrics failed error=%s", e)
+
+    async def publish(self, topic, payload, retain=False, qos=0):
+        """Publish and wait until the message is written (QoS 0) or acknowledged (QoS 1+)."""
+        return await asyncio.wrap_future(super().publish(topic, payload, retain, qos))
+
+    async def publish_many(self, messages, retain=False, qos=0):
+        """Publish (topic, payload) pairs and wait for all of them; returns their message ids."""
+        futures = MQTTClient.publish_many(self, messages, retain, qos)
+        return await asyncio.gather(*(asyncio.wrap_future(f) for f in futures))
+
+    def messages(self, topic_filter=None, maxsize=1000):
+        """Stream of (topic, payload) for messages matching topic_filter, or all of them."""
+        return MessageStream(self, topic_filter, maxsize)
+
+    async def cleanup(self):
+        self._closing = True
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self.last_values.close()
+        if self.client.is_connected():
+            if self._subscribed:
+                self.client.unsubscribe(sorted(self._subscribed))
+            self.client.disconnect()
+            try:
+                await asyncio.wait_for(self._disconnected.wait(), 5)
+            except asyncio.TimeoutError:
+                log.warning("disconnect timed out")
+
+
+class MessageStream:
+    """Async iterator over the messages matching one topic filter.
+
+    Messages are queued as they arrive; when more than maxsize are waiting the oldest
+    is dropped and counted in `dropped`. close() (or leaving `async with`) stops the
+    stream and removes its subscription.
+    """
+
+    def __init__(self, client, topic_filter, maxsize):
+        self._client = client
+        self._filter = topic_filter
+        self._queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+        client.on_message(self._put, topic_filter=topic_filter)
+
+    def _put(self, topic, payload):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait((topic, payload))
+
+    def close(self):
+        self._client.off_message(self._put, self._filter)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._queue.get()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
@@ -0,0 +1,100 @@
+import logging
+import threading
+from collections import deque
+
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+
+log = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    """Runs a handler for submitted items on a pool of worker threads.
+
+    Items with the same key always go to the same worker, so they are handled in the
+    order they were submitted. Each worker has its own bounded queue; when it is full
+    the backpressure policy decides whether submit() blocks, drops the oldest queued
+    item or drops the new one.
+    """
+
+    def __init__(self, handler, workers=4, queue_size=1000, backpressure=BLOCK):
+        if backpressure not in (BLOCK, DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"Unknown backpressure policy: {backpressure}")
+        self._handler = handler
+        self.backpressure = backpressure
+        self._max_len = max(1, queue_size // workers)
+        self._shards = [_Shard() for _ in range(workers)]
+        self._running = True
+        self._threads = []
+        for i, shard in enumerate(self._shards):
+            thread = threading.Thread(target=self._work, args=(shard,), name=f"mqtt-dispatch-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, item):
+        shard = self._shards[hash(key) % len(self._shards)]
+        with shard.lock:
+            if len(shard.items) >= self._max_len:
+                if self.backpressure == DROP_NEWEST:
+                    shard.dropped += 1
+                    return False
+                if self.backpressure == DROP_OLDEST:
+                    shard.items.popleft()
+                    shard.dropped += 1
+                else:
+                    while len(shard.items) >= self._max_len and self._running:
+                        shard.not_full.wait()
+            shard.items.append(item)
+            shard.not_empty.notify()
+        return True
+
+    def _work(self, shard):
+        while True:
+            with shard.lock:
+                while not shard.items and self._running:
+                    shard.not_empty.wait()
+                if not shard.items:
+                    return
+                item = shard.items.popleft()
+                shard.not_full.notify()
+            try:
+                self._handler(item)
+            except Exception:
+                log.exception("error while dispatching message")
+            shard.processed += 1
+
+    @property
+    def queue_depth(self):
+        return sum(len(shard.items) for shard in self._shards)
+
+    @property
+    def dropped(self):
+        return sum(shard.dropped for shard in self._shards)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "dropped": self.dropped,
+            "processed": sum(shard.processed for shard in self._shards),
+        }
+
+    def stop(self, timeout=None):
+        """Let the workers finish what is queued, then stop them."""
+        self._running = False
+        for shard in self._shards:
+            with shard.lock:
+                shard.not_empty.notify_all()
+                shard.not_full.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+
+class _Shard:
+    def __init__(self):
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.dropped = 0
+        self.processed = 0
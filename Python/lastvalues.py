@@ -0,0 +1,144 @@
+import logging
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from topictrie import covers
+
+MAGIC = b"LVC1"
+RECORD = struct.Struct("<HIBd")  # Topic length, payload length, retain flag, timestamp
+
+log = logging.getLogger(__name__)
+
+
+class LastValueCache:
+    """Latest payload, retain flag and receive time per topic, kept in memory.
+
+    When more than max_entries topics are known, the one updated longest ago is evicted.
+    With a path, the cache is loaded from that file when it is created and written back
+    every snapshot_interval seconds (only if something changed) and on close(), so after a
+    restart the last known values are there straight away instead of after the broker
+    has resent its retained messages.
+
+        cache = LastValueCache(path="lastvalues.bin")
+        cache.update("pin", b"on", retain=True)
+        payload, retain, timestamp = cache.get("pin")
+        cache.match("sensors/#")  # {topic: (payload, retain, timestamp)}
+
+    The snapshot is a small binary file: MAGIC, then per topic a RECORD header followed by
+    the topic and payload bytes, oldest first. It is written to a temporary file that then
+    replaces the old one, so a crash halfway through leaves the previous snapshot intact.
+    """
+
+    def __init__(self, max_entries=1024, path=None, snapshot_interval=30):
+        self.max_entries = max_entries
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.evicted = 0
+        self._values = OrderedDict()  # topic -> (payload, retain, timestamp), least recently updated first
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._timer = None
+        if path:
+            self.load()
+            if snapshot_interval:
+                self._schedule_snapshot()
+
+    def update(self, topic, payload, retain=False, timestamp=None):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        with self._lock:
+            self._values[topic] = (bytes(payload), bool(retain), timestamp or time.time())
+            self._values.move_to_end(topic)
+            while len(self._values) > self.max_entries:
+                self._values.popitem(last=False)
+                self.evicted += 1
+            self._dirty = True
+
+    def get(self, topic, default=None):
+        return self._values.get(topic, default)
+
+    def match(self, topic_filter):
+        with self._lock:
+            return {topic: entry for topic, entry in self._values.items() if covers(topic_filter, topic)}
+
+    def remove(self, topic):
+        with self._lock:
+            if self._values.pop(topic, None) is not None:
+                self._dirty = True
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, topic):
+        return topic in self._values
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            entries = list(self._values.items())
+            self._dirty = False
+        chunks = [MAGIC]
+        for topic, (payload, retain, timestamp) in entries:
+            name = topic.encode()
+            chunks.append(RECORD.pack(len(name), len(payload), retain, timestamp))
+            chunks.append(name)
+            chunks.append(payload)
+        temp = self.path + ".tmp"
+        try:
+            with open(temp, "wb") as f:
+                f.write(b"".join(chunks))
+            os.replace(temp, self.path)
+        except OSError as e:
+            log.error("saving last values failed path=%s error=%s", self.path, e)
+            self._dirty = True
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            log.error("loading last values failed path=%s error=%s", self.path, e)
+            return
+        if data[:len(MAGIC)] != MAGIC:
+            log.warning("ignoring snapshot without header path=%s", self.path)
+            return
+        values = OrderedDict()
+        pos = len(MAGIC)
+        while pos + RECORD.size <= len(data):
+            topic_len, payload_len, retain, timestamp = RECORD.unpack_from(data, pos)
+            start = pos + RECORD.size
+            pos = start + topic_len + payload_len
+            if pos > len(data):
+                break  # Truncated record
+            topic = data[start:start + topic_len].decode()
+            values[topic] = (data[start + topic_len:pos], bool(retain), timestamp)
+        while len(values) > self.max_entries:
+            values.popitem(last=False)
+        with self._lock:
+            # Anything received while we were loading is newer than the snapshot
+            values.update(self._values)
+            self._values = values
+
+    def _schedule_snapshot(self):
+        self._timer = threading.Timer(self.snapshot_interval, self._snapshot_periodically)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _snapshot_periodically(self):
+        if self._dirty:
+            self.save()
+        if self.snapshot_interval:
+            self._schedule_snapshot()
+
+    def close(self):
+        self.snapshot_interval = None
+        if self._timer:
+            self._timer.cancel()
+        if self._dirty:
+            self.save()
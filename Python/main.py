@@ -1,26 +1,41 @@
+import asyncio
+import logging
+import os
 import signal
-import sys
-import time
 
-from mqttclient import MQTTClient
+from asyncmqttclient import AsyncMQTTClient
 from pinController import PinController
 
-pin = PinController()
-mqtt = MQTTClient()
+# systemd points STATE_DIRECTORY at the unit's StateDirectory (/var/lib/mqttclient); when run
+# by hand the cache sits next to this script, wherever it is started from
+CACHE_PATH = os.path.join(os.environ.get("STATE_DIRECTORY", os.path.dirname(os.path.abspath(__file__))), "lastvalues.bin")
 
-mqtt.subscribe("pin")
-mqtt.on_message(pin.handle_message)
 
+async def main():
+    # Set level=logging.DEBUG to see every message sent and received
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    # Pin levels and last values are restored from the cache before we even connect
+    mqtt = AsyncMQTTClient(cache_path=CACHE_PATH)
+    pin = PinController(cache=mqtt.last_values)
+
+    for topic in pin.topics:
+        mqtt.on_message(pin.handle_message, topic_filter=topic)
+
+    await mqtt.connect()
+
+    # Everything runs on this event loop; wait here until we're told to stop
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+
+    print("🚀 Running. Press Ctrl+C to quit.")
+    await stop.wait()
 
-def cleanup(sig, frame):
     print("\n🛑 Exiting...")
-    mqtt.cleanup()
+    await mqtt.cleanup()
     pin.cleanup()
-    sys.exit(0)
-
 
-signal.signal(signal.SIGINT, cleanup)
 
-print("🚀 Running. Press Ctrl+C to quit.")
-while True:
-    time.sleep(1)
+asyncio.run(main())
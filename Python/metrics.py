@@ -0,0 +1,134 @@
+import threading
+import time
+
+ACK_LATENCY_BUCKETS_MS = (5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+CALLBACK_BUCKETS_US = (100, 500, 1000, 5000, 10000, 50000, 100000, 500000)
+
+
+class Histogram:
+    """Counts samples into fixed buckets; the last bucket holds everything above the top bound."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def snapshot(self):
+        return {
+            "buckets": list(self.bounds),
+            "counts": list(self.counts),
+            "count": self.count,
+            "mean": self.total // self.count if self.count else 0,
+            "max": self.max,
+        }
+
+
+class Metrics:
+    """Thread-safe message, latency and callback counters for MQTTClient.
+
+    Per-topic and per-callback tables are capped at `max_topics` entries so a client that
+    sees many distinct topics can't grow them without bound; the rest count as "other".
+    """
+
+    def __init__(self, max_topics=64):
+        self.max_topics = max_topics
+        self._lock = threading.Lock()
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.callback_errors = 0
+        self.reconnects = 0
+        self.topics_in = {}
+        self.topics_out = {}
+        self.ack_latency_ms = Histogram(ACK_LATENCY_BUCKETS_MS)
+        self.callback_us = Histogram(CALLBACK_BUCKETS_US)
+        self.slowest_callbacks = {}  # Callback name -> longest run in us
+        self._pending = {}  # mid -> send time of QoS > 0 messages waiting for their ack
+        self._early_acks = {}  # mid -> ack time, for acks that beat publish() returning
+        self._written = set()  # mids of QoS 0 messages whose on_publish (sent, not acked) is still to come
+
+    def _count_topic(self, topics, topic):
+        if topic in topics or len(topics) < self.max_topics:
+            topics[topic] = topics.get(topic, 0) + 1
+        else:
+            topics["other"] = topics.get("other", 0) + 1
+
+    def message_in(self, topic, size):
+        with self._lock:
+            self.messages_in += 1
+            self.bytes_in += size
+            self._count_topic(self.topics_in, topic)
+
+    def message_out(self, topic, size, mid, qos, sent):
+        # paho calls on_publish from its network thread, possibly before publish() has returned.
+        # mid is None when no on_publish will follow, e.g. for a QoS 0 message sent while offline.
+        with self._lock:
+            self.messages_out += 1
+            self.bytes_out += size
+            self._count_topic(self.topics_out, topic)
+            if mid is None:
+                return
+            acked = self._early_acks.pop(mid, None)
+            if not qos:
+                if acked is None:
+                    self._written.add(mid)
+                return
+            if acked is None:
+                self._pending[mid] = sent
+            else:
+                self.ack_latency_ms.add((acked - sent) // 1000000)
+
+    def ack(self, mid):
+        now = time.monotonic_ns()
+        with self._lock:
+            if mid in self._written:
+                self._written.discard(mid)  # A QoS 0 message went out; there is no latency to record
+                return
+            sent = self._pending.pop(mid, None)
+            if sent is None:
+                self._early_acks[mid] = now
+            else:
+                self.ack_latency_ms.add((now - sent) // 1000000)
+
+    def callback_done(self, callback, elapsed_us, failed=False):
+        name = getattr(callback, "__qualname__", None) or getattr(callback, "__name__", "callback")
+        with self._lock:
+            self.callback_us.add(elapsed_us)
+            if failed:
+                self.callback_errors += 1
+            if elapsed_us > self.slowest_callbacks.get(name, -1):
+                if name in self.slowest_callbacks or len(self.slowest_callbacks) < self.max_topics:
+                    self.slowest_callbacks[name] = elapsed_us
+
+    def reconnected(self):
+        with self._lock:
+            self.reconnects += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "messages_in": self.messages_in,
+                "messages_out": self.messages_out,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "callback_errors": self.callback_errors,
+                "reconnects": self.reconnects,
+                "inflight": len(self._pending),
+                "topics_in": dict(self.topics_in),
+                "topics_out": dict(self.topics_out),
+                "ack_latency_ms": self.ack_latency_ms.snapshot(),
+                "callback_us": self.callback_us.snapshot(),
+                "slowest_callbacks": dict(self.slowest_callbacks),
+            }
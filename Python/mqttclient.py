@@ -1,43 +1,272 @@
+import json
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import Future
+
 import paho.mqtt.client as mqtt
 
+from dispatcher import BLOCK, Dispatcher
+from lastvalues import LastValueCache
+from metrics import Metrics
+from topictrie import TopicTrie, minimal_filters
+
+log = logging.getLogger(__name__)
+
 
 class MQTTClient:
-    def __init__(self, broker="localhost", port=1883, topic="#"):
-        self._subscribers = []
+    def __init__(self, broker="localhost", port=1883, topic=None, workers=0, queue_size=1000, backpressure=BLOCK, metrics_interval=None, metrics_topic=None, share_group=None, cache_size=1024, cache_path=None, snapshot_interval=30,
+                 max_inflight=20, max_queued=0):
+        self._subscribers = []  # Callbacks without a topic filter get every message we receive
+        self._filters = []  # (topic_filter, callback)
+        self._index = TopicTrie()
+        self._topics = {topic} if topic else set()  # Explicitly subscribed topics
+        self._subscribed = set()  # What the broker currently has for us
+        # The filters and _subscribed change from the caller's thread and from paho's network
+        # thread (on_connect). Reentrant, as the methods that change them call _sync_subscriptions.
+        self._subscriptions_lock = threading.RLock()
         self.topic = topic
+        # With a share group, filters are subscribed as $share/<group>/<filter> and the broker
+        # spreads their messages over all clients in the group, except for exclusive ones
+        self.share_group = share_group
+        self._exclusive = set()
+        # With workers, callbacks run on a thread pool instead of paho's network thread
+        self._dispatcher = Dispatcher(self._dispatch, workers, queue_size, backpressure) if workers else None
+        self.metrics = Metrics()
+        self._connected_before = False
+        # Optionally publish get_metrics() every metrics_interval seconds
+        self.metrics_interval = metrics_interval
+        self.metrics_topic = metrics_topic or f"status/{socket.gethostname()}/metrics"
+        self._metrics_timer = None
+        # Latest payload per topic; with a cache_path it survives restarts (see lastvalues.py)
+        self.last_values = LastValueCache(cache_size, cache_path, snapshot_interval)
+
+        # publish() returns a Future per message, resolved from on_publish
+        self._futures = {}  # mid -> (future, qos)
+        self._early_acks = set()  # mids whose on_publish came before publish() returned
+        self._futures_lock = threading.Lock()
 
         self.client = mqtt.Client()
+        # QoS > 0 messages beyond max_inflight wait in paho's queue, which holds at most
+        # max_queued of them (0 is unbounded); publishing to a full queue fails
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.max_queued_messages_set(max_queued)
         self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
         self.client.on_message = self._on_message
+        self.client.on_publish = self._on_publish
+        self._start(broker, port)
+
+    def _start(self, broker, port):
+        # Runs paho's network loop on its own thread; callbacks are called from there
         self.client.connect(broker, port, 60)
         self.client.loop_start()
+        if self.metrics_interval:
+            self._schedule_metrics()
 
     def _on_connect(self, client, userdata, flags, rc):
         if rc == 0:
-            print("MQTT Connected")
-            self.subscribe(self.topic)
+            log.info("connected broker=%s:%s", client.host, client.port)
+            if self._connected_before:
+                self.metrics.reconnected()
+            self._connected_before = True
+            with self._subscriptions_lock:
+                self._subscribed = set()
+                self._sync_subscriptions()
         else:
-            print(f"MQTT Connect failed: {rc}")
+            log.error("connect failed rc=%s (%s)", rc, mqtt.connack_string(rc))
+
+    def _on_disconnect(self, client, userdata, rc):
+        if rc:
+            log.warning("connection lost rc=%s (%s)", rc, mqtt.error_string(rc))
+        # QoS 0 messages that weren't written yet are gone; QoS 1 ones are resent on reconnect
+        with self._futures_lock:
+            lost = [mid for mid, (_, qos) in self._futures.items() if not qos]
+            lost = [self._futures.pop(mid)[0] for mid in lost]
+        for future in lost:
+            future.set_exception(ConnectionError("Disconnected before the message was sent"))
 
-    def subscribe(self, topic):
-        self.client.subscribe(topic)
+    def subscribe(self, topic, shared=True):
+        with self._subscriptions_lock:
+            self._topics.add(topic)
+            if not shared:
+                self._exclusive.add(topic)
+            self._sync_subscriptions()
 
     def unsubscribe(self, topic):
-        self.client.unsubscribe(topic)
+        with self._subscriptions_lock:
+            self._topics.discard(topic)
+            self._exclusive.discard(topic)
+            self._sync_subscriptions()
+
+    def _sync_subscriptions(self):
+        # Ask the broker only for the smallest set of filters that covers everything registered.
+        # The requests go out under the lock too, so two threads can't send overlapping ones.
+        with self._subscriptions_lock:
+            filters = self._topics | {f for f, _ in self._filters}
+            exclusive = filters & self._exclusive
+            wanted = set(minimal_filters(exclusive))
+            for f in minimal_filters(filters - exclusive):
+                wanted.add(f"$share/{self.share_group}/{f}" if self.share_group else f)
+            added = wanted - self._subscribed
+            removed = self._subscribed - wanted
+            self._subscribed = wanted
+            if not self.client.is_connected():
+                return
+            if added:
+                self.client.subscribe([(topic, 0) for topic in sorted(added)])
+            if removed:
+                self.client.unsubscribe(sorted(removed))
 
     def publish(self, topic, payload, retain=False, qos=0):
-        self.client.publish(topic, payload, retain=retain, qos=qos)
-        print(f"📤 {topic}: {payload} (retain={retain}, qos={qos})")
+        """Publish and return a Future that resolves to the message id once the message
+        is written (QoS 0) or acknowledged by the broker (QoS 1 and 2).
+
+        It fails with ConnectionError if a QoS 0 message can't be sent, or if paho's
+        queue is full (see max_queued). QoS 1 and 2 messages published while offline
+        stay pending until they are delivered after reconnecting.
+        """
+        return self._track(self._publish(topic, payload, retain, qos), topic, qos)
+
+    def publish_many(self, messages, retain=False, qos=0):
+        """Publish (topic, payload) pairs and return their futures, in order.
+
+            futures = client.publish_many(readings, qos=1)
+            concurrent.futures.wait(futures, timeout=10)
+        """
+        return [self._track(self._publish(topic, payload, retain, qos), topic, qos) for topic, payload in messages]
+
+    def _publish(self, topic, payload, retain, qos):
+        sent = time.monotonic_ns()
+        info = self.client.publish(topic, payload, retain=retain, qos=qos)
+        size = len(payload) if isinstance(payload, (bytes, bytearray)) else len(str(payload if payload is not None else "").encode())
+        # No on_publish follows for a QoS 0 message paho couldn't send, or one refused by a full queue
+        acked = info.rc == mqtt.MQTT_ERR_SUCCESS or (qos and info.rc != mqtt.MQTT_ERR_QUEUE_SIZE)
+        self.metrics.message_out(topic, size, info.mid if acked else None, qos, sent)
+        log.debug("publish topic=%s size=%d qos=%d retain=%s mid=%d rc=%s", topic, size, qos, retain, info.mid, info.rc)
+        return info
+
+    def _track(self, info, topic, qos):
+        future = Future()
+        failed = info.rc == mqtt.MQTT_ERR_QUEUE_SIZE or (not qos and info.rc != mqtt.MQTT_ERR_SUCCESS)
+        if failed:
+            future.set_exception(ConnectionError(f"Publish to {topic} failed: {mqtt.error_string(info.rc)}"))
+            return future
+        with self._futures_lock:
+            acked = info.mid in self._early_acks
+            if acked:
+                self._early_acks.discard(info.mid)
+            else:
+                self._futures[info.mid] = (future, qos)
+        if acked:
+            future.set_result(info.mid)
+        return future
+
+    def _on_publish(self, client, userdata, mid):
+        self.metrics.ack(mid)
+        with self._futures_lock:
+            entry = self._futures.pop(mid, None)
+            if entry is None:
+                self._early_acks.add(mid)
+        if entry is not None:
+            entry[0].set_result(mid)
 
     def _on_message(self, client, userdata, msg):
+        self.metrics.message_in(msg.topic, len(msg.payload))
+        self.last_values.update(msg.topic, msg.payload, msg.retain)
+        if self._dispatcher:
+            self._dispatcher.submit(msg.topic, msg)
+        else:
+            self._dispatch(msg)
+
+    def _dispatch(self, msg):
+        callbacks = self._index.match(msg.topic)
+        if not callbacks and not self._subscribers:
+            return
         payload = msg.payload.decode()
-        print(f"MQTT Client received: {msg.topic}: {payload}")
+        log.debug("received topic=%s size=%d retain=%s", msg.topic, len(msg.payload), msg.retain)
         for callback in self._subscribers:
-            callback(msg.topic, payload)
+            self._run_callback(callback, msg.topic, payload)
+        for callback in callbacks:
+            if callback not in self._subscribers:
+                self._run_callback(callback, msg.topic, payload)
+
+    def _run_callback(self, callback, topic, payload):
+        start = time.perf_counter_ns()
+        failed = True
+        try:
+            callback(topic, payload)
+            failed = False
+        finally:
+            self.metrics.callback_done(callback, (time.perf_counter_ns() - start) // 1000, failed)
+
+    def on_message(self, callback, topic_filter=None, replay=False):
+        # With replay, the callback is first called with the cached last values it matches
+        if replay:
+            for topic, (payload, _, _) in self.last_values.match(topic_filter or "#").items():
+                self._run_callback(callback, topic, payload.decode())
+        if topic_filter is None:
+            self._subscribers.append(callback)
+            return
+        with self._subscriptions_lock:
+            self._filters.append((topic_filter, callback))
+            self._rebuild_index()
+
+    def off_message(self, callback, topic_filter=None):
+        if topic_filter is None:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+            return
+        with self._subscriptions_lock:
+            if (topic_filter, callback) in self._filters:
+                self._filters.remove((topic_filter, callback))
+                self._rebuild_index()
+
+    def _rebuild_index(self):
+        # Swap in a freshly built index so the network thread never sees a half-updated one
+        index = TopicTrie()
+        for f, cb in self._filters:
+            index.add(f, cb)
+        self._index = index
+        self._sync_subscriptions()
+
+    def last_value(self, topic, default=None):
+        entry = self.last_values.get(topic)
+        return entry[0].decode() if entry is not None else default
+
+    def dispatch_stats(self):
+        if not self._dispatcher:
+            return {"queue_depth": 0, "dropped": 0}
+        return self._dispatcher.stats()
+
+    def get_metrics(self):
+        metrics = self.metrics.snapshot()
+        metrics["dispatch"] = self.dispatch_stats()
+        return metrics
+
+    def publish_metrics(self, topic=None):
+        return self.publish(topic or self.metrics_topic, json.dumps(self.get_metrics()))
+
+    def _schedule_metrics(self):
+        self._metrics_timer = threading.Timer(self.metrics_interval, self._publish_metrics_periodically)
+        self._metrics_timer.daemon = True
+        self._metrics_timer.start()
 
-    def on_message(self, callback):
-        self._subscribers.append(callback)
+    def _publish_metrics_periodically(self):
+        if self.client.is_connected():
+            self.publish_metrics()
+        if self.metrics_interval:
+            self._schedule_metrics()
 
     def cleanup(self):
-        self.unsubscribe(self.topic)
+        self.metrics_interval = None
+        if self._metrics_timer:
+            self._metrics_timer.cancel()
+        self.last_values.close()
+        with self._subscriptions_lock:
+            if self._subscribed:
+                self.client.unsubscribe(sorted(self._subscribed))
         self.client.disconnect()
+        if self._dispatcher:
+            self._dispatcher.stop()
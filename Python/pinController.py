@@ -1,30 +1,141 @@
+import logging
+import threading
+
 import lgpio
 
+log = logging.getLogger(__name__)
+
+STATE_PREFIX = "$local/pin/"  # Cache keys for pin levels; never a topic the broker sends us
+
 
 class PinController:
-    def __init__(self, gpio_pin=14, topic="pin"):
+    def __init__(self, gpio_pin=14, topic="pin", pins=None, coalesce_ms=0, cache=None):
+        # pins maps topic -> GPIO number; without it we drive the single gpio_pin on topic
+        self.pins = dict(pins) if pins else {topic: gpio_pin}
         self.topic = topic
-        self.state = 0
-        self.gpio_pin = gpio_pin
+        self.topics = list(self.pins)
+        self.gpios = sorted(set(self.pins.values()))
+        # With a LastValueCache (e.g. MQTTClient.last_values) every level we write is kept
+        # there too, and pins start at their last level instead of off. Pulses, blinks and
+        # PWM are not restarted: they come back as the level they were recorded with.
+        self.cache = cache
+        self.states = {gpio: self._restored_state(gpio) for gpio in self.gpios}
+        # Commands arriving within coalesce_ms of each other are written in one go, last one wins
+        self.coalesce_ms = coalesce_ms
+        self.gpio_writes = 0
+        self._bits = {gpio: 1 << i for i, gpio in enumerate(self.gpios)}
+        self._pending = {}
+        self._waves = set()  # GPIOs currently driven by lgpio's pulse/PWM engine
+        self._timer = None
+        self._lock = threading.Lock()
         self.h = lgpio.gpiochip_open(0)  # Open the GPIO chip
-        lgpio.gpio_claim_output(self.h, self.gpio_pin)
+        lgpio.group_claim_output(self.h, self.gpios, [self.states[gpio] for gpio in self.gpios])
+
+    def _restored_state(self, gpio):
+        entry = self.cache.get(f"{STATE_PREFIX}{gpio}") if self.cache is not None else None
+        return 1 if entry is not None and entry[0] == b"1" else 0
+
+    def _remember(self, gpio):
+        if self.cache is not None:
+            self.cache.update(f"{STATE_PREFIX}{gpio}", b"1" if self.states[gpio] else b"0")
 
     def handle_message(self, topic, payload):
-        if topic != self.topic:
+        if topic not in self.pins:
             return
 
-        print(f"PinController received: {topic}: {payload}")
-        if payload.lower() == "on":
-            self.state = 1
-        elif payload.lower() == "off":
-            self.state = 0
-        elif payload.lower() == "toggle":
-            self.state = 1 - self.state
-        else:
-            print(f"PinController received an invalid payload: {payload} for topic: {topic}. Expected 'on', 'off' or 'toggle'.")
+        log.debug("command topic=%s payload=%s", topic, payload)
+        self.apply({topic: payload})
+
+    def apply(self, commands):
+        # Set several pins ('on', 'off' or 'toggle' per topic) with a single group write.
+        # Timed actions ('pulse:', 'blink:', 'pwm:') start right away on lgpio's own timer.
+        with self._lock:
+            for topic, payload in commands.items():
+                gpio = self.pins[topic]
+                command = payload.strip().lower()
+                if ":" in command:
+                    self._pending.pop(gpio, None)
+                    self._start_wave(topic, gpio, command)
+                    continue
+                if gpio in self._waves:
+                    self._stop_wave(gpio)
+                current = self._pending.get(gpio, self.states[gpio])
+                if command == "on":
+                    self._pending[gpio] = 1
+                elif command == "off":
+                    self._pending[gpio] = 0
+                elif command == "toggle":
+                    self._pending[gpio] = 1 - current
+                else:
+                    self._invalid(topic, payload)
+            if not self.coalesce_ms:
+                self._write_pending()
+            elif self._pending and self._timer is None:
+                self._timer = threading.Timer(self.coalesce_ms / 1000, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _start_wave(self, topic, gpio, command):
+        action, _, args = command.partition(":")
+        try:
+            values = [float(v) for v in args.split(",")]
+            if action == "pulse" and len(values) == 1:
+                lgpio.tx_pulse(self.h, gpio, int(values[0] * 1000), 0, 0, 1)
+                state = 0
+            elif action == "blink" and len(values) == 3:
+                times, on_ms, off_ms = values
+                lgpio.tx_pulse(self.h, gpio, int(on_ms * 1000), int(off_ms * 1000), 0, int(times))
+                state = 0
+            elif action == "pwm" and len(values) == 2:
+                frequency, duty = values
+                lgpio.tx_pwm(self.h, gpio, frequency, duty)
+                state = 1 if frequency and duty else 0
+            else:
+                raise ValueError(command)
+        except (ValueError, lgpio.error):
+            self._invalid(topic, command)
             return
-        lgpio.gpio_write(self.h, self.gpio_pin, self.state)
+        # Pulses and blinks end low, so a later 'toggle' switches the pin on
+        self.states[gpio] = state
+        self._remember(gpio)
+        self._waves.add(gpio)
+
+    def _stop_wave(self, gpio):
+        lgpio.tx_pulse(self.h, gpio, 0, 0)
+        self._waves.discard(gpio)
+
+    @staticmethod
+    def _invalid(topic, payload):
+        log.warning("invalid payload topic=%s payload=%s; expected 'on', 'off', 'toggle', 'pulse:<ms>', "
+                    "'blink:<n>,<on_ms>,<off_ms>' or 'pwm:<freq>,<duty>'", topic, payload)
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            self._write_pending()
+
+    def _write_pending(self):
+        bits = 0
+        mask = 0
+        for gpio, state in self._pending.items():
+            self.states[gpio] = state
+            self._remember(gpio)
+            mask |= self._bits[gpio]
+            if state:
+                bits |= self._bits[gpio]
+        self._pending.clear()
+        if mask:
+            lgpio.group_write(self.h, self.gpios[0], bits, mask)
+            self.gpio_writes += 1
 
     def cleanup(self):
-        lgpio.gpio_write(self.h, self.gpio_pin, 0)
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._pending.clear()
+            for gpio in list(self._waves):
+                self._stop_wave(gpio)
+            lgpio.group_write(self.h, self.gpios[0], 0)
+            lgpio.group_free(self.h, self.gpios[0])
         lgpio.gpiochip_close(self.h)
@@ -0,0 +1,165 @@
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+import zlib
+
+from mqttclient import MQTTClient
+
+log = logging.getLogger(__name__)
+
+STATS_SUMMED = ("messages_in", "messages_out", "bytes_in", "bytes_out", "callback_errors", "reconnects")
+
+
+def crc32_affinity(topic_filter, workers):
+    """Default affinity: a stable hash, so a filter lands on the same worker after restarts."""
+    return zlib.crc32(topic_filter.encode()) % workers
+
+
+class ReceiverPool:
+    """Runs MQTTClient receivers in several processes, so handlers can use more than one core.
+
+    Every worker joins the `shared` filters as $share/<group>/<filter>, and the broker
+    hands each message to just one of them. Shared messages can be handled out of order
+    across workers. Filters in `affine` are not shared: each one is pinned to a single
+    worker, which subscribes to it directly, so its messages stay in order. For example,
+    every message for one GPIO pin goes to the same process.
+
+    `setup(client, worker_id, affine)` runs in each worker after its client is created.
+    It gets the affine filters assigned to that worker, registers handlers with
+    client.on_message(...), and returns an optional cleanup function.
+
+        pool = ReceiverPool(setup, workers=4, shared=["sensors/#"], affine=["pin/14", "pin/15"])
+        pool.run()  # until Ctrl+C; dead workers are restarted
+
+    The supervisor restarts workers that die, with a backoff if they keep dying. stats()
+    adds up the metrics the workers report every `stats_interval` seconds.
+    """
+
+    RESTART_DELAY = 1  # Seconds, doubled for a worker that dies again soon after starting
+    RESTART_DELAY_MAX = 60
+    STABLE_AFTER = 30  # Seconds a worker must live before its restart delay is reset
+
+    def __init__(self, setup, workers=4, shared=(), affine=(), group="receivers", broker="localhost", port=1883,
+                 affinity=crc32_affinity, stats_interval=5):
+        self.setup = setup
+        self.workers = workers
+        self.shared = list(shared)
+        self.group = group
+        self.broker = broker
+        self.port = port
+        self.stats_interval = stats_interval
+        self.assignment = [[] for _ in range(workers)]  # Affine filters per worker
+        for topic_filter in affine:
+            self.assignment[affinity(topic_filter, workers)].append(topic_filter)
+        self.restarts = 0
+        self._stopping = False
+        # Workers are stopped with SIGTERM and report over a pipe each, rather than through a
+        # shared Event or Queue whose lock a killed worker could leave held
+        self._processes = [None] * workers
+        self._pipes = [None] * workers
+        self._started = [0.0] * workers
+        self._delay = [self.RESTART_DELAY] * workers
+        self._restart_at = [0.0] * workers
+        self._stats = {}
+
+    def start(self):
+        self._stopping = False
+        for i in range(self.workers):
+            self._spawn(i)
+
+    def _spawn(self, i):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=_run_worker,
+            args=(i, self.broker, self.port, self.group, self.shared, self.assignment[i], self.setup,
+                  writer, self.stats_interval),
+            name=f"mqtt-receiver-{i}",
+            daemon=True,
+        )
+        process.start()
+        writer.close()
+        self._processes[i] = process
+        self._pipes[i] = reader
+        self._started[i] = time.monotonic()
+
+    def supervise(self):
+        """Restart dead workers and collect their stats; call this regularly, or use run()."""
+        now = time.monotonic()
+        for i, process in enumerate(self._processes):
+            if process is None or process.is_alive() or self._stopping:
+                continue
+            if not self._restart_at[i]:
+                if now - self._started[i] >= self.STABLE_AFTER:
+                    self._delay[i] = self.RESTART_DELAY
+                log.warning("receiver exited worker=%d exitcode=%s restart_in=%ss", i, process.exitcode, self._delay[i])
+                self._restart_at[i] = now + self._delay[i]
+                self._delay[i] = min(self._delay[i] * 2, self.RESTART_DELAY_MAX)
+            elif now >= self._restart_at[i]:
+                self._restart_at[i] = 0.0
+                self.restarts += 1
+                self._spawn(i)
+        self._collect_stats()
+
+    def _collect_stats(self):
+        for i, pipe in enumerate(self._pipes):
+            try:
+                while pipe is not None and pipe.poll():
+                    self._stats[i] = pipe.recv()
+            except (EOFError, OSError):
+                pass  # The worker is gone; supervise() takes care of it
+
+    def run(self):
+        self.start()
+        try:
+            while not self._stopping:
+                self.supervise()
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            log.info("stopping receivers")
+        self.stop()
+
+    def stop(self, timeout=5):
+        self._stopping = True
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()  # SIGTERM: the worker disconnects and sends its last stats
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            if process is None:
+                continue
+            while process.is_alive() and time.monotonic() < deadline:
+                self._collect_stats()
+                process.join(0.1)
+            if process.is_alive():
+                process.kill()
+        self._collect_stats()
+
+    def stats(self):
+        totals = {key: sum(stats.get(key, 0) for stats in self._stats.values()) for key in STATS_SUMMED}
+        totals["workers"] = self.workers
+        totals["alive"] = sum(1 for p in self._processes if p is not None and p.is_alive())
+        totals["restarts"] = self.restarts
+        totals["per_worker"] = dict(self._stats)
+        return totals
+
+
+def _run_worker(worker_id, broker, port, group, shared, affine, setup, stats_pipe, stats_interval):
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C is for the supervisor, which stops us
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    client = MQTTClient(broker, port, share_group=group)
+    for topic_filter in affine:
+        client.subscribe(topic_filter, shared=False)
+    for topic_filter in shared:
+        client.subscribe(topic_filter)
+    cleanup = setup(client, worker_id, affine) if setup else None
+    try:
+        while not stop.wait(stats_interval):
+            stats_pipe.send(client.get_metrics())
+        stats_pipe.send(client.get_metrics())
+    finally:
+        client.cleanup()
+        if cleanup:
+            cleanup()
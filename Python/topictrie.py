@@ -0,0 +1,62 @@
+# Topic filter helpers following the MQTT 3.1.1 matching rules (section 4.7): '+' matches
+# exactly one level, '#' matches the parent level and everything below it, and wildcards at
+# the first level never match topics starting with '$'.
+
+
+class TopicTrie:
+    def __init__(self, cache_size=256):
+        self._root = ({}, [])  # (children, callbacks)
+        self._cache = {}
+        self._cache_size = cache_size
+
+    def add(self, topic_filter, callback):
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node[0].setdefault(level, ({}, []))
+        node[1].append(callback)
+        self._cache.clear()
+
+    def match(self, topic):
+        callbacks = self._cache.get(topic)
+        if callbacks is None:
+            callbacks = []
+            self._collect(self._root, topic.split("/"), 0, topic.startswith("$"), callbacks)
+            if len(self._cache) >= self._cache_size:
+                del self._cache[next(iter(self._cache))]
+            self._cache[topic] = callbacks
+        return callbacks
+
+    def _collect(self, node, levels, depth, system, out):
+        children = node[0]
+        wildcards = not (system and depth == 0)
+        if wildcards and "#" in children:
+            out.extend(cb for cb in children["#"][1] if cb not in out)
+        if depth == len(levels):
+            out.extend(cb for cb in node[1] if cb not in out)
+            return
+        if levels[depth] in children:
+            self._collect(children[levels[depth]], levels, depth + 1, system, out)
+        if wildcards and "+" in children:
+            self._collect(children["+"], levels, depth + 1, system, out)
+
+
+def covers(outer, inner):
+    """True if every topic matched by filter `inner` is also matched by filter `outer`."""
+    o = outer.split("/")
+    i = inner.split("/")
+    if i[0].startswith("$") and o[0] in ("+", "#"):
+        return False
+    for depth, level in enumerate(o):
+        if level == "#":
+            return True
+        if depth == len(i) or i[depth] == "#":
+            return False
+        if level != "+" and level != i[depth]:
+            return False
+    return len(o) == len(i)
+
+
+def minimal_filters(filters):
+    """Drop every filter that another filter in the set already covers."""
+    unique = sorted(set(filters))
+    return [f for f in unique if not any(g != f and covers(g, f) for g in unique)]
@@ -0,0 +1,299 @@
+# In-process MQTT 3.1.1 broker stand-in for the benchmarks. It speaks just enough of the
+# protocol for the clients in this repo: CONNECT, PUBLISH (QoS 0/1), SUBSCRIBE,
+# UNSUBSCRIBE, PINGREQ and DISCONNECT, routing messages between connected clients.
+# Shared subscriptions ($share/<group>/<filter>) get their messages round-robin.
+# MQTT 5 clients get properties where they are required, and topic aliases both ways.
+import socket
+import struct
+import threading
+import time
+
+
+def topic_matches(topic_filter, topic):
+    f = topic_filter.split("/")
+    t = topic.split("/")
+    if topic.startswith("$") and f[0] in ("+", "#"):
+        return False
+    for i, level in enumerate(f):
+        if level == "#":
+            return True
+        if i >= len(t) or (level != "+" and level != t[i]):
+            return False
+    return len(f) == len(t)
+
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        digit = n & 0x7F
+        n >>= 7
+        out.append(digit | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+def decode_length(buf, i):
+    n = 0
+    shift = 0
+    while True:
+        b = buf[i]
+        i += 1
+        n |= (b & 0x7F) << shift
+        shift += 7
+        if not b & 0x80:
+            return n, i
+
+
+def topic_alias(body, i):
+    # The Topic Alias (0x23) among the MQTT 5 properties at body[i], or 0; skips the rest
+    n, i = decode_length(body, i)
+    end = i + n
+    while i < end:
+        prop = body[i]
+        if prop == 0x23:
+            return struct.unpack_from("!H", body, i + 1)[0]
+        if prop in (0x01, 0x17, 0x19, 0x24, 0x25, 0x28, 0x29, 0x2A):
+            i += 2
+        elif prop in (0x13, 0x21, 0x22):
+            i += 3
+        elif prop in (0x02, 0x11, 0x18, 0x27):
+            i += 5
+        elif prop == 0x0B:
+            i = decode_length(body, i + 1)[1]
+        else:
+            i += 3 + struct.unpack_from("!H", body, i + 1)[0]
+            if prop == 0x26:
+                i += 2 + struct.unpack_from("!H", body, i)[0]
+    return 0
+
+
+def publish_packet(topic, payload, qos=0, pid=0, retain=False, v5=False, alias=0):
+    topic = topic.encode() if isinstance(topic, str) else topic
+    body = struct.pack("!H", len(topic)) + topic
+    if qos:
+        body += struct.pack("!H", pid)
+    if v5:
+        body += struct.pack("!BBH", 3, 0x23, alias) if alias else b"\x00"
+    body += payload
+    return bytes([0x30 | qos << 1 | retain]) + encode_length(len(body)) + body
+
+
+class _Session:
+    def __init__(self, conn):
+        self.conn = conn
+        self.filters = []
+        self.lock = threading.RLock()
+        self.v5 = False
+        self.alias_max = 0  # Aliases the client takes from us
+        self.out_aliases = {}  # topic -> alias we use towards the client
+        self.in_aliases = {}  # alias -> topic the client set up
+        self.unacked = 0
+
+    def send(self, data):
+        with self.lock:
+            try:
+                self.conn.sendall(data)
+            except OSError:
+                pass
+
+
+class Broker:
+    def __init__(self, ack_delay=0.0, topic_alias_maximum=0, receive_maximum=None, record=False):
+        self.ack_delay = ack_delay  # Seconds before PUBACK/CONNACK, to simulate a network round trip
+        self.topic_alias_maximum = topic_alias_maximum  # Told to MQTT 5 clients in CONNACK
+        self.receive_maximum = receive_maximum
+        self.connects = 0
+        self.received = 0
+        self.bytes_received = 0  # Size of all PUBLISH packets, fixed header included
+        self.max_unacked = 0  # Most QoS 1 messages a client had waiting for their PUBACK, with receive_maximum
+        self.pings = 0
+        self.messages = [] if record else None  # (topic, payload) of every PUBLISH received, resends included
+        self._sessions = []
+        self._share_next = {}  # (group, filter) -> round-robin counter
+        self._lock = threading.Lock()
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("127.0.0.1", 0))
+        self._server.listen(16)
+        self.port = self._server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        self._server.close()
+        self.drop_connections()
+
+    def drop_connections(self):
+        # Hang up on every client, as a broker restart or a lost link would
+        with self._lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            try:
+                session.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def publish(self, topic, payload):
+        self._route(topic, payload)
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._serve, args=(_Session(conn),), daemon=True).start()
+
+    def _reply(self, session, data):
+        if self.ack_delay:
+            threading.Timer(self.ack_delay, session.send, (data,)).start()
+        else:
+            session.send(data)
+
+    def _puback(self, session, data):
+        with self._lock:
+            session.unacked -= 1
+        session.send(data)
+
+    def _serve(self, session):
+        reader = session.conn.makefile("rb")
+        try:
+            while True:
+                header = reader.read(1)
+                if not header:
+                    break
+                length = 0
+                shift = 0
+                while True:
+                    b = reader.read(1)[0]
+                    length |= (b & 0x7F) << shift
+                    shift += 7
+                    if not b & 0x80:
+                        break
+                body = reader.read(length) if length else b""
+                if header[0] >> 4 == 3:
+                    self.bytes_received += 1 + len(encode_length(length)) + length
+                if not self._handle(session, header[0], body):
+                    break
+        except (OSError, IndexError):
+            pass
+        with self._lock:
+            if session in self._sessions:
+                self._sessions.remove(session)
+        session.conn.close()
+
+    def _handle(self, session, op, body):
+        kind = op >> 4
+        if kind == 1:  # CONNECT
+            self.connects += 1
+            session.v5 = body[6] == 5
+            connack = b"\x20\x02\x00\x00"
+            if session.v5:
+                n, i = decode_length(body, 10)
+                end = i + n
+                while i < end:  # The client's properties; only its Topic Alias Maximum matters here
+                    if body[i] == 0x22:
+                        session.alias_max = struct.unpack_from("!H", body, i + 1)[0]
+                    i += 5 if body[i] == 0x11 else 3
+                props = b""
+                if self.topic_alias_maximum:
+                    props += struct.pack("!BH", 0x22, self.topic_alias_maximum)
+                if self.receive_maximum:
+                    props += struct.pack("!BH", 0x21, self.receive_maximum)
+                body = b"\x00\x00" + encode_length(len(props)) + props
+                connack = b"\x20" + encode_length(len(body)) + body
+            with self._lock:
+                self._sessions.append(session)
+            if self.ack_delay:
+                time.sleep(self.ack_delay)
+            session.send(connack)
+        elif kind == 3:  # PUBLISH
+            self.received += 1
+            qos = (op >> 1) & 3
+            n = struct.unpack_from("!H", body)[0]
+            topic = body[2:2 + n].decode()
+            offset = 2 + n
+            if qos:
+                puback = b"\x40\x02" + body[offset:offset + 2]
+                if self.receive_maximum:
+                    # Count what the client has outstanding, to check it stays within our limit
+                    with self._lock:
+                        session.unacked += 1
+                        self.max_unacked = max(self.max_unacked, session.unacked)
+                    if self.ack_delay:
+                        threading.Timer(self.ack_delay, self._puback, (session, puback)).start()
+                    else:
+                        self._puback(session, puback)
+                else:
+                    self._reply(session, puback)
+                offset += 2
+            if session.v5:
+                alias = topic_alias(body, offset)
+                if alias:
+                    if topic:
+                        session.in_aliases[alias] = topic
+                    else:
+                        topic = session.in_aliases[alias]
+                offset = sum(decode_length(body, offset))
+            if self.messages is not None:
+                self.messages.append((topic, bytes(body[offset:])))
+            self._route(topic, body[offset:])
+        elif kind == 8:  # SUBSCRIBE
+            offset = sum(decode_length(body, 2)) if session.v5 else 2
+            codes = bytearray()
+            while offset < len(body):
+                n = struct.unpack_from("!H", body, offset)[0]
+                session.filters.append(body[offset + 2:offset + 2 + n].decode())
+                codes.append(min(body[offset + 2 + n], 1))
+                offset += 3 + n
+            props = b"\x00" if session.v5 else b""
+            session.send(bytes([0x90, 2 + len(props) + len(codes)]) + body[:2] + props + bytes(codes))
+        elif kind == 10:  # UNSUBSCRIBE
+            offset = 2
+            while offset < len(body):
+                n = struct.unpack_from("!H", body, offset)[0]
+                topic_filter = body[offset + 2:offset + 2 + n].decode()
+                if topic_filter in session.filters:
+                    session.filters.remove(topic_filter)
+                offset += 2 + n
+            session.send(b"\xb0\x02" + body[:2])
+        elif kind == 12:  # PINGREQ
+            self.pings += 1
+            session.send(b"\xd0\x00")
+        elif kind == 14:  # DISCONNECT
+            return False
+        return True
+
+    def _route(self, topic, payload):
+        packet = publish_packet(topic, payload)
+        with self._lock:
+            sessions = list(self._sessions)
+        shared = {}
+        for session in sessions:
+            direct = False
+            for f in session.filters:
+                if f.startswith("$share/"):
+                    _, group, real = f.split("/", 2)
+                    if topic_matches(real, topic):
+                        shared.setdefault((group, real), []).append(session)
+                elif topic_matches(f, topic):
+                    direct = True
+            if direct:
+                self._deliver(session, topic, payload, packet)
+        for key, members in shared.items():
+            n = self._share_next.get(key, 0)
+            self._share_next[key] = n + 1
+            self._deliver(members[n % len(members)], topic, payload, packet)
+
+    def _deliver(self, session, topic, payload, packet):
+        if not session.v5:
+            session.send(packet)
+            return
+        with session.lock:  # The packet that sets up an alias has to go out before its first use
+            alias = session.out_aliases.get(topic)
+            if alias:
+                session.send(publish_packet(b"", payload, v5=True, alias=alias))
+                return
+            if len(session.out_aliases) < session.alias_max:
+                alias = session.out_aliases[topic] = len(session.out_aliases) + 1
+            session.send(publish_packet(topic, payload, v5=True, alias=alias or 0))
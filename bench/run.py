@@ -0,0 +1,444 @@
+"""Offline benchmarks for the MicroPython and Python MQTT clients.
+
+Runs on plain CPython with no network: the MicroPython modules are loaded unchanged on top
+of the stand-ins in bench/shims, and all traffic goes to the in-process broker in
+bench/broker.py over loopback.
+
+    python bench/run.py                        # full run, JSON on stdout
+    python bench/run.py --quick --out new.json
+    python bench/run.py --compare old.json     # exit status 1 on regressions
+
+The delivery checks are not timings: they count messages lost when the broker drops the
+connection mid-publish, and any loss makes the run exit with status 1.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [BENCH_DIR, os.path.join(BENCH_DIR, "shims"), os.path.join(ROOT, "MicroPython"), os.path.join(ROOT, "Python")]
+
+
+def _install_time_shims():
+    # MicroPython's time has the wrapping ticks_* helpers, CPython's doesn't
+    if hasattr(time, "ticks_ms"):
+        return
+    period = 1 << 30
+    time.ticks_ms = lambda: int(time.monotonic() * 1000) % period
+    time.ticks_us = lambda: int(time.monotonic() * 1000000) % period
+    time.ticks_add = lambda ticks, delta: (ticks + delta) % period
+
+    def ticks_diff(a, b):
+        return ((a - b + period // 2) % period) - period // 2
+
+    time.ticks_diff = ticks_diff
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+
+
+_install_time_shims()
+
+import umqttsimple  # noqa: E402
+from broker import Broker, publish_packet  # noqa: E402
+from mqtt_handler import MQTTHandler  # noqa: E402
+from mqtt_handler_async import AsyncMQTTHandler  # noqa: E402
+from outbox import Outbox  # noqa: E402
+
+TOPIC = b"sensors/temperature"
+
+
+class NullSocket:
+    # Swallows writes and counts them, for measuring the encoder on its own
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, buf, n=None):
+        n = len(buf) if n is None else n
+        self.writes += 1
+        self.bytes += n
+        return n
+
+    def setblocking(self, flag):
+        pass
+
+
+class ReplaySocket:
+    # Serves a prerecorded byte stream, for measuring the decoder on its own
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+        self.reads = 0
+
+    def _take(self, n):
+        self.reads += 1
+        chunk = self.data[self.pos:self.pos + n]
+        self.pos += len(chunk)
+        return chunk
+
+    def read(self, n):
+        return bytes(self._take(n))
+
+    def readinto(self, buf, n=None):
+        chunk = self._take(n or len(buf))
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+    def write(self, buf, n=None):
+        return len(buf) if n is None else n
+
+    def setblocking(self, flag):
+        pass
+
+
+def _rate(count, seconds):
+    return round(count / seconds, 1) if seconds else None
+
+
+def _timed(fn, repeat=3):
+    # Best of a few runs, so a busy machine doesn't read as a regression
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def _client(sock=None):
+    client = umqttsimple.MQTTClient(b"bench", "127.0.0.1")
+    client.set_callback(lambda topic, msg: None)
+    client.sock = sock
+    return client
+
+
+def bench_encode(n):
+    results = {}
+    for size in (8, 64, 512):
+        payload = b"x" * size
+        client = _client()
+        batch = _client()
+
+        def publish():
+            client.sock = NullSocket()
+            for _ in range(n):
+                client.publish(TOPIC, payload)
+
+        def publish_batch():
+            batch.sock = NullSocket()
+            batch.publish_batch((TOPIC, payload) for _ in range(n))
+
+        seconds = _timed(publish)
+        batch_seconds = _timed(publish_batch)
+        results[f"payload_{size}"] = {
+            "publish_per_s": _rate(n, seconds),
+            "writes_per_msg": client.sock.writes / n,
+            "bytes_per_msg": client.sock.bytes / n,
+            "batch_publish_per_s": _rate(n, batch_seconds),
+            "batch_writes_per_msg": batch.sock.writes / n,
+        }
+    return results
+
+
+def bench_decode(n):
+    results = {}
+    for size in (8, 64, 512):
+        stream = publish_packet(TOPIC, b"x" * size) * n
+        client = _client()
+
+        def decode():
+            client.sock = ReplaySocket(stream)
+            for _ in range(n):
+                client.wait_msg()
+
+        seconds = _timed(decode)
+        results[f"payload_{size}"] = {
+            "decode_per_s": _rate(n, seconds),
+            "reads_per_msg": client.sock.reads / n,
+        }
+    return results
+
+
+def bench_topic_alias(n):
+    # Bytes on the wire per message for a typical topic, MQTT 3.1.1 against MQTT 5 with topic aliases
+    results = {}
+    for protocol in (4, 5):
+        client = umqttsimple.MQTTClient(b"bench", "127.0.0.1", protocol=protocol)
+        client._alias_max = 16  # What a broker would grant in its CONNACK
+
+        def publish():
+            client.sock = NullSocket()
+            for _ in range(n):
+                client.publish(b"home/living_room/light", b"on")
+
+        seconds = _timed(publish)
+        results[f"mqtt{protocol}"] = {
+            "publish_per_s": _rate(n, seconds),
+            "bytes_per_msg": round(client.sock.bytes / n, 2),
+        }
+    return results
+
+
+def _publish_run(broker, n, qos, max_inflight=1):
+    handler = MQTTHandler("127.0.0.1", broker.port, max_inflight=max_inflight)
+    handler.connect()
+    payload = {"value": 21.5}
+    start = time.perf_counter()
+    for _ in range(n):
+        handler.publish_message(TOPIC, payload, qos=qos)
+    handler.wait_for_acks()
+    seconds = time.perf_counter() - start
+    handler.disconnect()
+    return _rate(n, seconds)
+
+
+def bench_publish(n):
+    broker = Broker()
+    slow_broker = Broker(ack_delay=0.002)
+    try:
+        return {
+            "qos0_per_s": _publish_run(broker, n, 0),
+            "qos1_per_s": _publish_run(broker, n, 1),
+            "qos1_window16_per_s": _publish_run(broker, n, 1, max_inflight=16),
+            "qos1_rtt2ms_per_s": _publish_run(slow_broker, max(n // 20, 10), 1),
+            "qos1_rtt2ms_window16_per_s": _publish_run(slow_broker, max(n // 4, 10), 1, max_inflight=16),
+        }
+    finally:
+        broker.close()
+        slow_broker.close()
+
+
+def bench_publish_async(n):
+    async def run(port, qos, max_inflight):
+        handler = AsyncMQTTHandler("127.0.0.1", port, max_inflight=max_inflight)
+        await handler.connect()
+        start = time.perf_counter()
+        for _ in range(n):
+            await handler.publish_message(TOPIC, {"value": 21.5}, qos=qos)
+        await handler.wait_for_acks()
+        seconds = time.perf_counter() - start
+        await handler.disconnect()
+        return _rate(n, seconds)
+
+    broker = Broker()
+    try:
+        return {
+            "qos0_per_s": asyncio.run(run(broker.port, 0, 1)),
+            "qos1_window16_per_s": asyncio.run(run(broker.port, 1, 16)),
+        }
+    finally:
+        broker.close()
+
+
+def bench_dispatch(n):
+    results = {}
+    for count in (1, 10, 100, 1000):
+        handler = MQTTHandler()
+        for i in range(count):
+            handler._add_subscription(f"sensors/device{i}/+", lambda topic, message: None, 0)
+        topics = [f"sensors/device{i % count}/temperature".encode() for i in range(64)]
+
+        def dispatch():
+            for i in range(n):
+                handler._message_callback(topics[i & 63], b"21.5")
+
+        results[f"subscriptions_{count}"] = {"us_per_msg": round(_timed(dispatch) / n * 1e6, 3)}
+    return results
+
+
+def _peak_bytes(fn, n):
+    # Average transient Python heap use of one call, as seen by tracemalloc
+    fn()
+    tracemalloc.start()
+    total = 0
+    for _ in range(n):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        fn()
+        total += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return round(total / n, 1)
+
+
+def bench_allocations(n):
+    n = min(n, 2000)
+    publisher = _client(NullSocket())
+    receiver = _client(ReplaySocket(publish_packet(TOPIC, b"21.5") * (n + 1)))
+    handler = MQTTHandler()
+    handler._add_subscription("sensors/+", lambda topic, message: None, 0)
+    return {
+        "publish_bytes_per_msg": _peak_bytes(lambda: publisher.publish(TOPIC, b"21.5"), n),
+        "receive_bytes_per_msg": _peak_bytes(receiver.wait_msg, n),
+        "handler_dispatch_bytes_per_msg": _peak_bytes(lambda: handler._message_callback(TOPIC, b"21.5"), n),
+    }
+
+
+def bench_python_client(n):
+    try:
+        from mqttclient import MQTTClient
+    except ImportError as e:
+        return {"skipped": str(e)}
+    broker = Broker()
+    received = []
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            client = MQTTClient("127.0.0.1", broker.port)
+            client.on_message(lambda topic, payload: received.append(topic), topic_filter="sensors/#")
+            deadline = time.time() + 5
+            while not client.client.is_connected() and time.time() < deadline:
+                time.sleep(0.01)
+            time.sleep(0.1)
+            start = time.perf_counter()
+            for _ in range(n):
+                client.publish("sensors/temperature", "21.5")
+            publish_seconds = time.perf_counter() - start
+            while len(received) < n and time.time() < deadline + 10:
+                time.sleep(0.001)
+            receive_seconds = time.perf_counter() - start
+            client.cleanup()
+    finally:
+        broker.close()
+    return {
+        "publish_per_s": _rate(n, publish_seconds),
+        "roundtrip_per_s": _rate(len(received), receive_seconds),
+    }
+
+
+def _lost(broker, sent):
+    received = {payload for _, payload in broker.messages}
+    return sum(1 for payload in sent if payload not in received)
+
+
+async def _until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+
+def bench_delivery(n):
+    async def concurrent_qos1(broker, outbox=None):
+        # QoS 1 publishes waiting for an in-flight slot when the link drops
+        handler = AsyncMQTTHandler("127.0.0.1", broker.port, max_inflight=1, outbox=outbox)
+        task = asyncio.create_task(handler.run())
+        await _until(lambda: handler.connected)
+        sent = [b"concurrent-%d" % i for i in range(4)]
+        publishes = [asyncio.create_task(handler.publish_message(TOPIC, payload, qos=1)) for payload in sent]
+        await asyncio.sleep(0.05)
+        broker.drop_connections()
+        await asyncio.gather(*publishes, return_exceptions=True)
+        await _until(lambda: handler.connected and not handler.client.inflight)
+        await handler.disconnect()
+        await task
+        return sent
+
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        broker = Broker(ack_delay=0.2, record=True)
+        try:
+            results["async_qos1_concurrent_lost"] = _lost(broker, asyncio.run(concurrent_qos1(broker)))
+        finally:
+            broker.close()
+        broker = Broker(ack_delay=0.2, record=True)
+        path = os.path.join(BENCH_DIR, "outbox.tmp")
+        try:
+            outbox = Outbox(path)
+            sent = asyncio.run(concurrent_qos1(broker, outbox))
+            results["async_outbox_qos1_concurrent_lost"] = _lost(broker, sent)
+        finally:
+            broker.close()
+            os.remove(path)
+    return results
+
+
+BENCHMARKS = {
+    "encode": bench_encode,
+    "decode": bench_decode,
+    "publish": bench_publish,
+    "publish_async": bench_publish_async,
+    "topic_alias": bench_topic_alias,
+    "dispatch": bench_dispatch,
+    "allocations": bench_allocations,
+    "python_client": bench_python_client,
+    "delivery": bench_delivery,
+}
+
+
+def _leaves(tree, prefix=""):
+    for key, value in tree.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from _leaves(value, path + ".")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield path, value
+
+
+def compare(old, new, tolerance):
+    """Print metrics that got worse by more than `tolerance` and return how many there were."""
+    old_values = dict(_leaves(old["results"]))
+    regressions = 0
+    for path, value in _leaves(new["results"]):
+        before = old_values.get(path)
+        if not before or value is None:
+            continue
+        higher_is_better = path.endswith("_per_s")
+        change = (value - before) / before
+        worse = -change if higher_is_better else change
+        if worse > tolerance:
+            regressions += 1
+            print(f"REGRESSION {path}: {before} -> {value} ({change:+.0%})", file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="fewer iterations, for a smoke test")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument("--out", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="earlier results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown (default 0.2)")
+    args = parser.parse_args()
+
+    n = 2000 if args.quick else 20000
+    results = {}
+    for name in args.only or BENCHMARKS:
+        print(f"running {name}...", file=sys.stderr)
+        results[name] = BENCHMARKS[name](n)
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "iterations": n,
+        },
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    lost = [(path, value) for path, value in _leaves(results) if path.endswith("_lost") and value]
+    for path, value in lost:
+        print(f"LOST {path}: {value}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), report, args.tolerance):
+                sys.exit(1)
+    if lost:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
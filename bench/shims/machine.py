@@ -0,0 +1,74 @@
+# CPython stand-in for the parts of MicroPython's machine module this repo uses
+import threading
+import time
+
+
+def unique_id():
+    return b"\xbe\x4c\x00\x00\x00\x01"
+
+
+def reset():
+    raise SystemExit("machine.reset()")
+
+
+def lightsleep(ms=None):
+    time.sleep((ms or 0) / 1000)
+
+
+def idle():
+    pass
+
+
+class RTC:
+    def datetime(self):
+        t = time.localtime()
+        return (t.tm_year, t.tm_mon, t.tm_mday, t.tm_wday, t.tm_hour, t.tm_min, t.tm_sec, 0)
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+
+    def __init__(self, pin=None, mode=None):
+        self._value = 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = v
+
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, timer_id=-1):
+        self._thread = None
+
+    def init(self, mode=PERIODIC, period=1000, callback=None, freq=None):
+        self.deinit()
+        if freq:
+            period = 1000 / freq
+
+        def fire():
+            if mode == Timer.PERIODIC:
+                self._start(period, fire)
+            callback(self)
+
+        self._start(period, fire)
+
+    def _start(self, period, fn):
+        self._thread = threading.Timer(period / 1000, fn)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def deinit(self):
+        if self._thread is not None:
+            self._thread.cancel()
+            self._thread = None
@@ -0,0 +1,50 @@
+# CPython stand-in for MicroPython's usocket: stream-style read/write/readinto on a TCP socket
+import socket as _socket
+
+getaddrinfo = _socket.getaddrinfo
+
+
+class socket:
+    def __init__(self, *args):
+        self._sock = _socket.socket(*args)
+        self._sock.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_NODELAY, 1)
+
+    def connect(self, addr):
+        self._sock.connect(addr)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def setblocking(self, flag):
+        self._sock.setblocking(flag)
+
+    def settimeout(self, timeout):
+        self._sock.settimeout(timeout)
+
+    def close(self):
+        self._sock.close()
+
+    def write(self, buf, n=None):
+        if n is not None:
+            buf = memoryview(buf)[:n]
+        self._sock.sendall(buf)
+        return len(buf)
+
+    def read(self, n):
+        # Like MicroPython: a blocking read returns n bytes unless the peer closes first
+        data = b""
+        try:
+            while len(data) < n:
+                chunk = self._sock.recv(n - len(data))
+                if not chunk:
+                    break
+                data += chunk
+        except BlockingIOError:
+            return data or None
+        return data
+
+    def readinto(self, buf, n=None):
+        try:
+            return self._sock.recv_into(buf, n or len(buf))
+        except BlockingIOError:
+            return None
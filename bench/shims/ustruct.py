@@ -0,0 +1 @@
+from struct import *  # noqa: F401,F403